@@ -6,9 +6,12 @@ from scipy.stats import truncnorm
 
 from Configuration import configs
 from Map import G
+from Parser import passenger_days
+from Routing import shortest_duration, shortest_path, duration_matrix
 
 
 eventQueue = []
+edgeList = list(G.edges)
 
 
 # File is validated to include passenger attributes for future simulations.
@@ -17,7 +20,7 @@ def validate_passengers(passenger_file):
     cols = pd.read_csv(passenger_file, nrows=1).columns
     if 'patience' not in cols:
         print('Injecting passenger attributes...')
-        df = pd.read_csv(configs["passenger_file"])
+        df = pd.read_csv(passenger_file)
         df['tpep_pickup_datetime'] = (pd.to_datetime(df['tpep_pickup_datetime']) - pd.Timestamp('1970-01-01')) // pd.Timedelta('1s')
 
         # Calculate trip properties for access in future simulations
@@ -34,22 +37,31 @@ def validate_passengers(passenger_file):
         df['VoT'] = truncnorm.rvs(a=-3.125, b=1.875, loc=32, scale=3.2, size=df.shape[0])
 
         # Write back to passenger file with injected attributes
-        df.sort_values('tpep_pickup_datetime').to_csv(configs["passenger_file"], index=False)
+        df.sort_values('tpep_pickup_datetime').to_csv(passenger_file, index=False)
         print('Attribute injection is completed.')
 
 
+# All passenger files of the configured simulation are validated, e.g. once before running replications in parallel,
+# such that concurrent simulations do not inject different attributes into the same file
+def validate_inputs():
+    if configs['passenger_directory']:
+        for passenger_file in passenger_days(configs['passenger_directory']):
+            validate_passengers(passenger_file)
+    else:
+        validate_passengers(configs['passenger_file'])
+
+
 def random_loc():
-    rng = np.random.default_rng()
-    random_edge = rng.choice(G.edges)
+    random_edge = edgeList[np.random.randint(len(edgeList))]  # Global random state, which is seeded for replications
     random_dist = np.random.uniform(0, G.edges[random_edge]['distance'])
     return Location(random_edge[0], random_edge[1], random_dist)
 
 
 def path_between(from_loc, to_loc):
     assert (isinstance(from_loc, Location) and isinstance(to_loc, Location)), 'Path must be calculated between 2 locations.'
-    if (from_loc.source is to_loc.source) and (from_loc.target is to_loc.target) and (from_loc.timeFromSource < to_loc.timeFromSource):
+    if (from_loc.source == to_loc.source) and (from_loc.target == to_loc.target) and (from_loc.timeFromSource < to_loc.timeFromSource):
         return None  # There is no path if both are on the same road, and vehicle is upstream to passenger
-    return nx.shortest_path(G, from_loc.target, to_loc.source, weight='duration')
+    return shortest_path(from_loc.target, to_loc.source)
 
 
 def distance_between(from_loc, to_loc):
@@ -67,10 +79,10 @@ def distance_between(from_loc, to_loc):
 
 
 def duration_between(from_loc, to_loc):
-    if (from_loc.source is to_loc.source) and (from_loc.target is to_loc.target) and (from_loc.timeFromSource < to_loc.timeFromSource):
+    if (from_loc.source == to_loc.source) and (from_loc.target == to_loc.target) and (from_loc.timeFromSource < to_loc.timeFromSource):
         return to_loc.timeFromSource - from_loc.timeFromSource
     else:
-        cost = nx.shortest_path_length(G, from_loc.target, to_loc.source, weight='duration')
+        cost = shortest_duration(from_loc.target, to_loc.source)
 
     if from_loc.type != 'Intersection':
         cost += from_loc.timeFromTarget
@@ -79,6 +91,25 @@ def duration_between(from_loc, to_loc):
     return cost
 
 
+# Matrix of duration_between() for all pairs of from_locs (rows) and to_locs (columns), with batched shortest paths
+def durations_between(from_locs, to_locs):
+    cost = duration_matrix([f.target for f in from_locs], [l.source for l in to_locs])
+    fromTarget = np.array([f.timeFromTarget for f in from_locs])
+    fromSource = np.array([f.timeFromSource for f in from_locs])
+    toSource = np.array([l.timeFromSource for l in to_locs])
+    cost += fromTarget[:, None] + toSource[None, :]  # Times on roads are 0 at intersections
+
+    # Locations upstream on the same road reach the location directly
+    same = (np.array([f.source for f in from_locs])[:, None] == np.array([l.source for l in to_locs])[None, :]) & \
+           (np.array([f.target for f in from_locs])[:, None] == np.array([l.target for l in to_locs])[None, :]) & \
+           (fromSource[:, None] < toSource[None, :])
+    cost = np.where(same, toSource[None, :] - fromSource[:, None], cost)
+
+    if np.isinf(cost).any():
+        raise nx.NetworkXNoPath('No path between some of the locations.')
+    return cost.astype(int)  # Durations are in integer seconds, as road durations and times on roads
+
+
 class Location:
     def __init__(self, source: int, target: int = None, loc_from_source: float = 0):
         self.type = 'Intersection'  # Assume a location is at its source intersection
@@ -113,7 +144,7 @@ class Location:
 class Event:
     """ Event priorities, the triggering order at the same time
 
-        0 : NewHV, ActivateAVs/DeactivateAVs, UpdateStats
+        0 : NewHV, EndShift, ActivateAVs/DeactivateAVs
         1 : TripCompletion
         2 : UpdatePhi
         3 : NewPassenger
@@ -1,5 +1,7 @@
+import os
 import json
 
 # TODO: Validation of JSON schema may require installation of an additional library
-with open('Config.json', 'r') as jsonFile:
+# The configuration file can be replaced by the MIXEDFLEET_CONFIG environment variable, e.g. for replications
+with open(os.environ.get('MIXEDFLEET_CONFIG', 'Config.json'), 'r') as jsonFile:
     configs = json.load(jsonFile)
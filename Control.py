@@ -1,8 +1,41 @@
+import os
+import queue
+import atexit
+import threading
 import numpy as np
 import pandas as pd
 import do_mpc
 
 
+class OccupiedCounter:
+    """ Number of occupied vehicles over time (sec), as a Fenwick tree of +1/-1 changes at pick-up/drop-off times
+
+        Replaces per-assignment events which updated the counts, count(t) includes all changes up to time t.
+    """
+
+    def __init__(self, size=1 << 17):
+        self.tree = [0] * (size + 1)  # Size is a power of 2, covering one day by default
+
+    def add(self, t, change):
+        i = int(t) + 1
+        while i >= len(self.tree):
+            # Doubling the size only adds the total count at the new root, as new positions have no changes
+            total = self.count(len(self.tree) - 2)
+            self.tree += [0] * (len(self.tree) - 1)
+            self.tree[-1] = total
+        while i < len(self.tree):
+            self.tree[i] += change
+            i += i & -i
+
+    def count(self, t):
+        i = min(int(t) + 1, len(self.tree) - 1)
+        total = 0
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+
 class Statistics:
     # Simulation outputs
     vehicle_data = []
@@ -10,6 +43,7 @@ class Statistics:
     expiration_data = []
     assignment_data = []
     utilisation_data = []
+    matching_data = []
 
     # Simulation states
     lastPassengerTime = 0
@@ -17,9 +51,27 @@ class Statistics:
 
     HV_total = 0
     HV_trips = 0
-    HV_no = 0
+    HV_occupied = OccupiedCounter()
     AV_trips = 0
-    AV_no = 0
+    AV_occupied = OccupiedCounter()
+
+
+# Output tables with their columns and data types
+output_tables = {
+    'vehicle_data': {'v_id': 'int64', 'is_HV': 'bool', 'neoclassical': 'bool', 'income': 'double',
+                     'time': 'double', 'activation': 'bool'},
+    'passenger_data': {'p_id': 'int64', 'request_t': 'double', 'trip_d': 'double', 'trip_t': 'double',
+                       'VoT': 'double', 'fare': 'double', 'prefer_HV': 'bool', 'o_source': 'int64',
+                       'o_target': 'int64', 'o_loc': 'double', 'd_source': 'int64', 'd_target': 'int64',
+                       'd_loc': 'double', 'patience': 'double'},
+    'expiration_data': {'p_id': 'int64', 'expire_t': 'double'},
+    'assignment_data': {'v_id': 'int64', 'p_id': 'int64', 'dispatch_t': 'double', 'meeting_t': 'double',
+                        'delivery_t': 'double'},
+    'utilisation_data': {'time': 'double', 'v_id': 'int64', 'trip_utilisation': 'double'},
+    'matching_data': {'time': 'double', 'is_HV': 'bool', 'vehicles': 'int64', 'passengers': 'int64',
+                      'partitioned_obj': 'double', 'global_obj': 'double', 'gap': 'double',
+                      'partitioned_latency': 'double', 'global_latency': 'double'},
+}
 
 
 class Variables:
@@ -57,18 +109,108 @@ def compute_phi(nP, nV):
 
 
 def write_results(path, number):
-    pd.DataFrame(Statistics.vehicle_data, columns=['v_id', 'is_HV', 'neoclassical', 'income', 'time', 'activation']
-                 ).to_csv('{}/sim{}_vehicle_data.csv'.format(path, number), index=False)
-
-    pd.DataFrame(Statistics.passenger_data,
-                 columns=['p_id', 'request_t', 'trip_d', 'trip_t', 'VoT', 'fare', 'prefer_HV']
-                 ).to_csv('{}/sim{}_passenger_data.csv'.format(path, number), index=False)
-
-    pd.DataFrame(Statistics.expiration_data, columns=['p_id', 'expire_t']
-                 ).to_csv('{}/sim{}_expiration_data.csv'.format(path, number), index=False)
-
-    pd.DataFrame(Statistics.assignment_data, columns=['v_id', 'p_id', 'dispatch_t', 'meeting_t', 'delivery_t']
-                 ).to_csv('{}/sim{}_assignment_data.csv'.format(path, number), index=False)
-
-    pd.DataFrame(Statistics.utilisation_data, columns=['time', 'v_id', 'trip_utilisation']
-                 ).to_csv('{}/sim{}_utilisation_data.csv'.format(path, number), index=False)
+    for table, columns in output_tables.items():
+        if os.path.exists('{}/sim{}_{}.parquet'.format(path, number, table)):
+            os.remove('{}/sim{}_{}.parquet'.format(path, number, table))  # Otherwise read_results prefers old outputs
+        pd.DataFrame(getattr(Statistics, table), columns=list(columns)
+                     ).to_csv('{}/sim{}_{}.csv'.format(path, number, table), index=False)
+
+
+# Output table of a simulation, written by write_results() or ResultWriter
+def read_results(path, number, table):
+    file = '{}/sim{}_{}'.format(path, number, table)
+    if os.path.exists(file + '.parquet'):
+        return pd.read_parquet(file + '.parquet')
+    return pd.read_csv(file + '.csv')
+
+
+class ResultWriter:
+    """ Streams simulation outputs to disk while the event loop runs
+
+        flush() moves recorded rows of a table from Statistics into a bounded queue without waiting, once the table
+        has batch_rows rows (or any rows with force=True), batches which do not fit are kept and retried at the next
+        flush. A background thread appends batches to CSV files, or to Parquet files with one row group per batch,
+        using the same tables and columns as write_results().
+    """
+
+    def __init__(self, path, number, file_format='csv', queue_size=64, batch_rows=10000):
+        assert file_format in ('csv', 'parquet'), 'Cannot recognise output format {}.'.format(file_format)
+        self.file_format = file_format
+        self.files = {table: '{}/sim{}_{}.{}'.format(path, number, table, file_format) for table in output_tables}
+        self.parquetWriters = {}
+        self.batchRows = batch_rows
+        self.batches = queue.Queue(maxsize=queue_size)
+        self.pending = []
+        self.closed = False
+        self.error = None
+
+        # Remove outputs of a previous simulation with the same number, in both formats
+        for table in output_tables:
+            for extension in ('csv', 'parquet'):
+                file = '{}/sim{}_{}.{}'.format(path, number, table, extension)
+                if os.path.exists(file):
+                    os.remove(file)
+
+        self.thread = threading.Thread(target=self.consume, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)  # Keep streamed outputs if the simulation crashes
+
+    def flush(self, force=False):
+        for table in output_tables:
+            rows = getattr(Statistics, table)
+            if len(rows) >= self.batchRows or (force and rows):
+                setattr(Statistics, table, [])
+                self.pending.append((table, rows))
+
+        while self.pending:
+            try:
+                self.batches.put_nowait(self.pending[0])
+            except queue.Full:
+                break  # The main event loop never waits for disk I/O
+            self.pending.pop(0)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+
+        self.flush(force=True)
+        for batch in self.pending:
+            self.batches.put(batch)
+        self.pending.clear()
+        self.batches.put(None)
+        self.thread.join()
+
+        # Tables without any records are written with headers only, the same as write_results()
+        for table, columns in output_tables.items():
+            if not os.path.exists(self.files[table]):
+                self.write(table, [])
+        for writer in self.parquetWriters.values():
+            writer.close()
+
+        if self.error is not None:
+            raise self.error
+
+    def consume(self):
+        while True:
+            batch = self.batches.get()
+            if batch is None:
+                break
+            try:
+                self.write(*batch)
+            except Exception as e:  # Raised on close() in the main thread
+                self.error = e
+
+    def write(self, table, rows):
+        df = pd.DataFrame(rows, columns=list(output_tables[table]))
+        if self.file_format == 'csv':
+            exists = os.path.exists(self.files[table])
+            df.to_csv(self.files[table], mode='a' if exists else 'w', header=not exists, index=False)
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            schema = pa.schema([(c, pa.type_for_alias(t)) for c, t in output_tables[table].items()])
+            if table not in self.parquetWriters:
+                self.parquetWriters[table] = pq.ParquetWriter(self.files[table], schema)
+            self.parquetWriters[table].write_table(pa.Table.from_pandas(df, schema=schema, preserve_index=False))
@@ -2,13 +2,17 @@ from itertools import count
 import numpy as np
 
 from Parser import read_passengers
-from Basics import Event, Location, duration_between
+from Basics import Event, Location
 from Control import Variables, compute_phi, Statistics
+from Supply import Fleet
 
 
-def load_passengers(fraction=1, hours=18):
-    passenger_df = read_passengers(fraction, hours)
-    passenger_df['time'] = passenger_df['time']
+# Passengers of a daily trip file are loaded with a time offset, e.g. from midnight of each day in multi-day simulations
+# (see Parser.read_passengers), passengers before the simulation start are not simulated
+def load_passengers(fraction=1, hours=18, passenger_file=None, offset=0, from_midnight=False):
+    passenger_df = read_passengers(fraction, hours, passenger_file, from_midnight)
+    passenger_df['time'] = passenger_df['time'] + offset
+    passenger_df = passenger_df[passenger_df['time'] >= 0]
 
     # Update values of phi before creating new passengers
     for t in passenger_df['time'].unique():
@@ -23,12 +27,23 @@ def load_passengers(fraction=1, hours=18):
     Statistics.lastPassengerTime = passenger_df['time'].max()
 
 
+# Fare = Flag price + Unit price * Trip duration
+def trip_fares(trip_duration):
+    return Variables.HVf1 + Variables.HVf2 * trip_duration, Variables.AVf1 + Variables.AVf2 * trip_duration
+
+
+# Logit choice probabilities of [HV, AV, other modes] based on generalised costs (dis-utility), of passengers or arrays
+def choice_probabilities(GC_HV, GC_AV):
+    utility = np.exp([-GC_HV, -GC_AV, -Variables.others_GC * np.ones_like(GC_HV)])
+    return utility / sum(utility)
+
+
 class Passenger:
     _ids = count(0)
     p_HV = {}
     p_AV = {}
 
-    def __init__(self, time, origin, destination, trip_distance, trip_duration, patience, VoT, HVs=None, AVs=None):
+    def __init__(self, time, origin, destination, trip_distance, trip_duration, patience, VoT):
         self.id = next(self._ids)
         self.requestTime = time
         self.origin = origin
@@ -37,37 +52,36 @@ class Passenger:
         self.tripDuration = trip_duration
         self.expiredTime = time + patience
         self.VoT = VoT  # Value of time ($/hr)
-        self.preferHV, self.fare = Passenger.choose_vehicle(self, HVs, AVs)
+        self.preferHV, self.fare = self.choose_vehicle()
         if self.preferHV is not None:
             if self.preferHV:
                 Passenger.p_HV[self.id] = self
             elif ~self.preferHV:
                 Passenger.p_AV[self.id] = self
 
-        # Record data ['p_id', 'request_t', 'trip_d', 'trip_t', 'VoT', 'fare', 'prefer_HV']
-        Statistics.passenger_data.append([self.id, self.requestTime, self.tripDistance, self.tripDuration, self.VoT, self.fare, self.preferHV])
+        # Record data ['p_id', 'request_t', 'trip_d', 'trip_t', 'VoT', 'fare', 'prefer_HV',
+        #              'o_source', 'o_target', 'o_loc', 'd_source', 'd_target', 'd_loc', 'patience']
+        Statistics.passenger_data.append([self.id, self.requestTime, self.tripDistance, self.tripDuration, self.VoT, self.fare, self.preferHV,
+                                          origin.source, origin.target, origin.locFromSource,
+                                          destination.source, destination.target, destination.locFromSource,
+                                          self.expiredTime - self.requestTime])
 
     def __repr__(self):
         return 'Passenger_{}'.format(self.id)
 
-    def min_wait_time(self, vehicles):
-        nearest_time = float('inf')
-        for vehicle in vehicles:
-            nearest_time = min(duration_between(vehicle.loc, self.origin), nearest_time)
-        return nearest_time
+    def min_wait_time(self, is_HV):
+        return Fleet.nearest_time(is_HV, self.origin)  # Nearest vacant vehicle in the registry
 
-    def choose_vehicle(self, HV_v, AV_v):
-        # Fare = Flag price + Unit price * Trip duration
-        fare_HV = Variables.HVf1 + Variables.HVf2 * self.tripDuration
-        fare_AV = Variables.AVf1 + Variables.AVf2 * self.tripDuration
+    def choose_vehicle(self):
+        fare_HV, fare_AV = trip_fares(self.tripDuration)
 
         # TODO: When instantaneous demand > supply, give accurate ETA. Now capped ETA = 20 min, use search radius
         # Generalised cost = Fare + VoT / 3600 * (Estimation ratio * Time to the nearest vacant vehicle)
-        GC_HV = fare_HV + self.VoT / 3600 * Variables.phiHV * min(self.min_wait_time(HV_v), 1200)
-        GC_AV = fare_AV + self.VoT / 3600 * Variables.phiAV * min(self.min_wait_time(AV_v), 1200)
+        GC_HV = fare_HV + self.VoT / 3600 * Variables.phiHV * min(self.min_wait_time(True), 1200)
+        GC_AV = fare_AV + self.VoT / 3600 * Variables.phiAV * min(self.min_wait_time(False), 1200)
 
         # Logit choice based on GC (dis-utility) of vehicles
-        _c = np.random.choice(['HV', 'AV', 'others'], p=np.exp([-GC_HV, -GC_AV, -Variables.others_GC]) / sum(np.exp([-GC_HV, -GC_AV, -Variables.others_GC])))
+        _c = np.random.choice(['HV', 'AV', 'others'], p=choice_probabilities(GC_HV, GC_AV))
         if _c == 'HV':
             return True, fare_HV  # Prefer HV
         elif _c == 'AV':
@@ -112,5 +126,5 @@ class NewPassenger(Event):
     def __repr__(self):
         return 'Passenger@t{}'.format(self.time)
 
-    def trigger(self, HVs, AVs):
-        Passenger(self.time, *self.args, HVs, AVs)
+    def trigger(self):
+        return Passenger(self.time, *self.args)
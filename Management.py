@@ -1,48 +1,153 @@
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import networkx as nx
+from scipy.optimize import linear_sum_assignment
 
 from Configuration import configs
-from Basics import Event, duration_between
+from Map import partition_nodes
+from Basics import Event, durations_between
 from Control import Variables, Statistics
 from Demand import Passenger
-from Supply import HVs, activeAVs, TripCompletion, ActivateAVs, DeactivateAVs, cruiseAV
+from Supply import HVs, activeAVs, Fleet, TripCompletion, ActivateAVs, DeactivateAVs, cruiseAV
+from Trace import AssignmentTrace
 
 
 # Bipartite matching which minimises the total dispatch trip duration
 def bipartite_match(vacant_v, waiting_p):
+    vacant_v = list(vacant_v)
+    waiting_p = list(waiting_p)
     if (not vacant_v) | (not waiting_p):
         return None  # No matching if either set is empty
 
+    # Graph nodes are indices of vehicles (0, ..., n - 1) and passengers (n, ...) instead of objects, such that ties
+    # are broken in the same order in every run with the same random seed (common random numbers)
+    n = len(vacant_v)
+    cost = durations_between([v.loc for v in vacant_v], [p.origin for p in waiting_p])
     # bipartite_edges = []
     bipartite_graph = nx.DiGraph()
-    for p in waiting_p:
-        for v in vacant_v:
-            # _t = duration_between(v.loc, p.origin)
+    for j, p in enumerate(waiting_p):
+        for i, v in enumerate(vacant_v):
+            # _t = cost[i, j]
             # if _t <= 1200:  # Create bipartite edge if the pick-up time is within 30 min
-            bipartite_graph.add_node(v, bipartite=0)
-            bipartite_graph.add_node(p, bipartite=1)
-            bipartite_graph.add_edge(v, p, duration=duration_between(v.loc, p.origin))
+            bipartite_graph.add_node(i, bipartite=0)
+            bipartite_graph.add_node(n + j, bipartite=1)
+            bipartite_graph.add_edge(i, n + j, duration=cost[i, j].item())
 
     results = None
-    top_nodes = {n for n, d in bipartite_graph.nodes(data=True) if d['bipartite'] == 0}
+    top_nodes = set(range(n))
     if not nx.is_empty(bipartite_graph):
-        results = [(v, p, bipartite_graph.edges[v, p]['duration'])
-                   for v, p in nx.bipartite.minimum_weight_full_matching(bipartite_graph, top_nodes=top_nodes, weight='duration').items()
-                   if isinstance(p, Passenger)]
+        results = [(vacant_v[i], waiting_p[j - n], bipartite_graph.edges[i, j]['duration'])
+                   for i, j in nx.bipartite.minimum_weight_full_matching(bipartite_graph, top_nodes=top_nodes, weight='duration').items()
+                   if i in top_nodes]
 
     return results  # List of tuples with assigned (vehicle, passenger)
 
 
+# Partitioned matching mode, zones are solved in parallel when more than 1 zone is configured
+zoneOf, borderOf = partition_nodes(*configs['match_zones'])
+matchBorder = configs['match_border']  # Distance (feet, as node positions in EPSG:2263) to zone borders
+partitioned = max(zoneOf.values()) > 0
+matchPool = None  # Started by the first partitioned round, not on import (e.g. by Service.py or Trace.py)
+reportGap = configs['match_report_gap']
+
+
+def zone_pool():
+    global matchPool
+    if matchPool is None:
+        matchPool = ProcessPoolExecutor(configs['match_workers'])
+    return matchPool
+
+
+# Minimum total duration matching within a zone, returns index pairs of (vehicle, passenger, duration)
+def zone_match(vehicle_locs, passenger_locs):
+    cost = durations_between(vehicle_locs, passenger_locs)
+    rows, cols = linear_sum_assignment(cost)
+    return [(i, j, cost[i, j].item()) for i, j in zip(rows, cols)]
+
+
+def partitioned_match(vacant_v, waiting_p):
+    vacant_v = list(vacant_v)
+    waiting_p = list(waiting_p)
+    if (not vacant_v) | (not waiting_p):
+        return None  # No matching if either set is empty
+
+    # Group vehicles and passengers by zones, those close to zone borders are left for reconciliation
+    zone_v = defaultdict(list)
+    zone_p = defaultdict(list)
+    for v in vacant_v:
+        if borderOf[v.loc.source] > matchBorder:
+            zone_v[zoneOf[v.loc.source]].append(v)
+    for p in waiting_p:
+        if borderOf[p.origin.source] > matchBorder:
+            zone_p[zoneOf[p.origin.source]].append(p)
+
+    zones = [z for z in zone_v if z in zone_p]
+    solve = zone_pool().map if partitioned else map
+    results = []
+    for z, pairs in zip(zones, solve(zone_match, [[v.loc for v in zone_v[z]] for z in zones],
+                                     [[p.origin for p in zone_p[z]] for z in zones])):
+        results += [(zone_v[z][i], zone_p[z][j], d) for i, j, d in pairs]
+
+    # Reconciliation: the remaining vehicles and passengers (surplus in zones or at borders) are matched globally
+    matched_v = {m[0] for m in results}
+    matched_p = {m[1] for m in results}
+    reconciled = bipartite_match([v for v in vacant_v if v not in matched_v],
+                                 [p for p in waiting_p if p not in matched_p])
+    return results + (reconciled or [])
+
+
+def match(t, is_HV, vacant_v, waiting_p):
+    if not partitioned:
+        return bipartite_match(vacant_v, waiting_p)
+
+    _t0 = time.perf_counter()
+    results = partitioned_match(vacant_v, waiting_p)
+    partitioned_t = time.perf_counter() - _t0
+
+    if reportGap and results:
+        # Optimality gap of the partitioned matching against the global matching, for rounds with matches
+        _t0 = time.perf_counter()
+        global_results = bipartite_match(vacant_v, waiting_p)
+        global_t = time.perf_counter() - _t0
+
+        partitioned_obj = sum(m[2] for m in results)
+        global_obj = sum(m[2] for m in global_results or [])
+        gap = (partitioned_obj - global_obj) / global_obj if global_obj else 0
+
+        # Record data ['time', 'is_HV', 'vehicles', 'passengers', 'partitioned_obj', 'global_obj', 'gap',
+        #              'partitioned_latency', 'global_latency']
+        Statistics.matching_data.append([t, is_HV, len(vacant_v), len(waiting_p), partitioned_obj, global_obj, gap,
+                                         partitioned_t, global_t])
+    return results
+
+
+# Inputs of assignment rounds are recorded for offline benchmarking (see Trace.replay). The trace file is created by
+# the first assignment round, such that importing Management (e.g. by Trace.replay) never overwrites a trace.
+assignmentTrace = None
+
+
 def compute_assignment(t):
-    for v in (HVs | activeAVs).values():
-        # v.update_loc(t)  # Update vehicle location
-        v.time = t  # Update vehicle time
+    global assignmentTrace
+    Fleet.update_vacant_time(t)  # Update vacant vehicle time
 
     for p in (Passenger.p_HV | Passenger.p_AV).values():
         p.check_expiration(t)  # Remove expired passengers
 
+    # Vacant vehicles from the registry, in the order of ids
+    vacant_HVs = Fleet.vacant_vehicles(True)
+    vacant_AVs = Fleet.vacant_vehicles(False)
+
+    if configs['assignment_trace']:
+        if assignmentTrace is None:
+            assignmentTrace = AssignmentTrace(configs['assignment_trace'])
+        assignmentTrace.record(t, True, vacant_HVs, Passenger.p_HV.values())
+        assignmentTrace.record(t, False, vacant_AVs, Passenger.p_AV.values())
+
     # Compute and return minimum weighting full bipartite matching
-    HV_match = bipartite_match(HVs.values(), Passenger.p_HV.values())
-    AV_match = bipartite_match(activeAVs.values(), Passenger.p_AV.values())
+    HV_match = match(t, True, vacant_HVs, Passenger.p_HV.values())
+    AV_match = match(t, False, vacant_AVs, Passenger.p_AV.values())
     return HV_match, AV_match
 
 
@@ -80,6 +185,8 @@ class Assign(Event):
 
                     v.income += p.fare
 
+                Fleet.update(v, Fleet.OCCUPIED)
+
                 # Vehicle delivers passenger to passenger destination
                 v.time = delivery_t
                 v.loc = p.destination
@@ -88,10 +195,11 @@ class Assign(Event):
                 v.nextTrip = TripCompletion(delivery_t, v, drop_off=True)
 
                 # Update system statistics
+                occupied = Statistics.HV_occupied if v.is_HV else Statistics.AV_occupied
                 if meeting_t < Statistics.lastPassengerTime:
-                    UpdateOccupied(meeting_t, v.is_HV, 1)
+                    occupied.add(meeting_t, 1)
                 if delivery_t < Statistics.lastPassengerTime:
-                    UpdateOccupied(delivery_t, v.is_HV, -1)
+                    occupied.add(delivery_t, -1)
 
                 # Record data ['v_id', 'p_id', 'dispatch_t', 'meeting_t', 'delivery_t']
                 Statistics.assignment_data.append([v.id, p.id, self.time, meeting_t, delivery_t])
@@ -104,30 +212,14 @@ class Assign(Event):
 
 
 # Schedule assignment events, finish with assignment to catch all passengers
-def schedule_assignment(endTime):
-    roundEndTime = 0
-    for t in range(0, endTime + configs['match_interval'], configs['match_interval']):
+def schedule_assignment(endTime, startTime=0):
+    roundEndTime = startTime
+    for t in range(startTime, endTime + configs['match_interval'], configs['match_interval']):
         Assign(t)
         roundEndTime = t
     Statistics.lastPassengerTime = roundEndTime
 
 
-class UpdateOccupied(Event):
-    def __init__(self, time, isHV, change):
-        super().__init__(time, priority=0)
-        self.isHV = isHV
-        self.change = change
-
-    def __repr__(self):
-        return 'UpdateOccupied@t{} {}'.format(self.time, self.change)
-
-    def trigger(self):
-        if self.isHV:
-            Statistics.HV_no += self.change
-        else:
-            Statistics.AV_no += self.change
-
-
 # Dynamic AV fleet management: activation/deactivation
 def manage_AVs():
     # TODO: Add argument handlers for optimisation control
@@ -1,5 +1,6 @@
 import geopandas as gpd
 import momepy
+import numpy as np
 import networkx as nx
 import matplotlib.pyplot as plt
 
@@ -23,22 +24,35 @@ def plot_depots():
     plt.show()
 
 
-# TODO: Visualise results on map
-# H = graph.copy()
-# for n in H.nodes():
-#     H.nodes[n]['N'] = 0
-
-# # 1. Add new nodes in H based on Location.loc_from_source and Location.locFromTarget
-#     # node = xxx
-
-#     # 2. Overlapped nodes should be marked with a count value
-#     if H.has_node(node):
-#         node['N'] += 1
-#         pass
-
-# # 3. Remove old intersections without any agents
-# for n in H.nodes():
-#     if H.nodes[n]['N'] == 0:
-#         nx.remove_node(n)
-
-# # 4. Visualise overlapped graphs
+# Grid partition of the network into (rows x cols) zones with similar numbers of nodes, based on node positions.
+# Returns the zone of each node and its distance to the nearest zone border.
+def partition_nodes(rows, cols):
+    pos = np.array([G.nodes[n]['pos'] for n in G.nodes])
+    x_cuts = np.quantile(pos[:, 0], np.linspace(0, 1, cols + 1)[1:-1])
+    y_cuts = np.quantile(pos[:, 1], np.linspace(0, 1, rows + 1)[1:-1])
+    zones = np.searchsorted(y_cuts, pos[:, 1]) * cols + np.searchsorted(x_cuts, pos[:, 0])
+
+    border = np.full(len(pos), np.inf)
+    for x in x_cuts:
+        border = np.minimum(border, np.abs(pos[:, 0] - x))
+    for y in y_cuts:
+        border = np.minimum(border, np.abs(pos[:, 1] - y))
+    return dict(zip(G.nodes, zones.tolist())), dict(zip(G.nodes, border.tolist()))
+
+
+# Edge geometry arrays for vectorised positioning and plotting of results (see Visualisation.py), in the order of G.edges
+edgeIndex = {e: i for i, e in enumerate(G.edges)}
+edgeSource = np.array([G.nodes[u]['pos'] for u, v in G.edges])
+edgeTarget = np.array([G.nodes[v]['pos'] for u, v in G.edges])
+edgeLength = np.array([d for u, v, d in G.edges(data='distance')])
+
+
+# Edge indices and (x, y) positions of locations given as arrays of (source, target, location from source).
+# Locations at intersections (source == target) have edge index -1.
+def edge_positions(source, target, loc):
+    idx = np.array([edgeIndex.get((s, t), -1) for s, t in zip(source, target)], dtype=int)
+    onEdge = idx >= 0
+    xy = np.array([G.nodes[s]['pos'] for s in source], dtype=float).reshape(-1, 2)
+    ratio = np.asarray(loc, dtype=float)[onEdge] / edgeLength[idx[onEdge]]
+    xy[onEdge] += ratio[:, None] * (edgeTarget[idx[onEdge]] - edgeSource[idx[onEdge]])
+    return idx, xy
@@ -0,0 +1,309 @@
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+from Configuration import configs
+from Parser import read_passengers, depot_nodes
+from Map import G, partition_nodes
+from Routing import dijkstra, forward, nodes, node_index
+from Control import Variables, OccupiedCounter, compute_phi, read_results, output_tables
+from Demand import trip_fares, choice_probabilities
+from Basics import random_loc
+from Supply import HV_attributes, HV_joins, HV_retries, HV_continues
+from Replication import kpis, compute_kpis
+
+
+# Mesoscopic zone-level simulation for fast scenario screening.
+# The network is aggregated into zones (Map.partition_nodes) with a zone-to-zone travel time matrix between zone
+# centroids. Vehicles and passengers are balanced per time step with vectorised operations, using the same phi
+# estimation, logit mode choice and HV labour supply rules as the detailed (link-level, event-based) simulation.
+#
+# Usage: python Mesoscopic.py                  (KPIs of the mesoscopic simulation)
+#        python Mesoscopic.py [output_number]  (calibration report against outputs of the detailed simulation)
+PENDING, VACANT, OCCUPIED, EXITED = 0, 1, 2, 3
+
+
+# Zone of each node (in Routing order) and travel times (sec) between zone centroids, intra-zone times on the diagonal
+def build_zones(rows, cols):
+    zoneOf, _ = partition_nodes(rows, cols)
+    zone = np.array([zoneOf[n] for n in nodes])
+    pos = np.array([G.nodes[n]['pos'] for n in nodes])
+
+    size = rows * cols
+    travel = np.full((size, size), np.inf)
+    members = [np.flatnonzero(zone == z) for z in range(len(travel))]
+    centroids = [m[np.argmin(((pos[m] - pos[m].mean(axis=0)) ** 2).sum(axis=1))] if len(m) else None for m in members]
+    for z, c in enumerate(centroids):
+        if c is None:
+            continue
+        dist = dijkstra(forward, c)
+        travel[z] = [dist[c2] if c2 is not None else np.inf for c2 in centroids]
+        travel[z, z] = dist[members[z]][np.isfinite(dist[members[z]])].mean()
+    return zone, np.nan_to_num(travel, posinf=travel[np.isfinite(travel)].max())
+
+
+# Ranks of items within their zones, in the order of items
+def zone_ranks(zones):
+    order = np.argsort(zones, kind='stable')
+    ranks = np.empty(len(zones), dtype=int)
+    ranks[order] = np.arange(len(zones)) - np.searchsorted(zones[order], zones[order])
+    return ranks
+
+
+# Passengers are sampled from passenger_file, or given as passenger_data of a detailed simulation (see calibrate)
+def simulate(fraction=0.25, hours=18, step=None, zones=None, passengers=None):
+    step = step or configs['meso_step']
+    zone, travel = build_zones(*(zones or configs['meso_zones']))
+    maximumWork = configs['maximum_work_duration']
+
+    # Passengers, with ids in the order of request times
+    if passengers is None:
+        df = read_passengers(fraction, hours)
+    else:
+        df = passengers.rename(columns={'request_t': 'time', 'trip_d': 'trip_distance', 'trip_t': 'trip_duration'})
+    df = df.sort_values('time', kind='stable').reset_index(drop=True)
+    pTime = df['time'].to_numpy()
+    pZone = zone[[node_index[n] for n in df['o_source']]]
+    pDest = zone[[node_index[n] for n in df['d_source']]]
+    pDuration = df['trip_duration'].to_numpy()
+    pExpire = pTime + df['patience'].to_numpy()
+    pVoT = df['VoT'].to_numpy()
+    fare_HV, fare_AV = trip_fares(pDuration)
+    lastTime = pTime.max()
+    lastTime += -lastTime % configs['match_interval']  # Last assignment round, as in Management.schedule_assignment
+
+    # Vehicles: AVs take the first ids, as in the detailed simulation where AVs are instantiated when loaded and HVs
+    # when they join the market. Random draws follow Supply.load_vehicles (HV attributes and roads, then AV depots),
+    # such that HVs are the same for the same random seed, and vehicles are located at zones of roads and depots.
+    nAV = configs['AV_fleet_size']
+    nHV = configs['HV_fleet_size']
+    shift_start, neo, hourlyCost, targetIncome = map(np.array, HV_attributes(nHV))
+    HV_zones = zone[[node_index[random_loc().source] for _ in range(nHV)]]
+    AV_zones = zone[[node_index[d] for d in np.random.choice(depot_nodes, nAV)]]
+
+    isHV = np.r_[np.zeros(nAV, dtype=bool), np.ones(nHV, dtype=bool)]
+    status = np.full(nAV + nHV, PENDING)
+    vZone = np.r_[AV_zones, HV_zones]
+    status[np.random.choice(nAV, min(configs['AV_initial_size'], nAV), replace=False)] = VACANT
+    joinAt = np.r_[np.zeros(nAV), shift_start].astype(float)
+    neo = np.r_[np.zeros(nAV, dtype=bool), neo]
+    hourlyCost = np.r_[np.ones(nAV), hourlyCost]
+    targetIncome = np.r_[np.zeros(nAV), targetIncome]
+    freeAt = np.zeros(nAV + nHV)
+    tripStart = np.zeros(nAV + nHV)
+    occupiedTime = np.zeros(nAV + nHV)
+    income = np.zeros(nAV + nHV)
+    HV_occupied = OccupiedCounter()
+    HV_total = 0
+    firstTime = True
+
+    records = {table: [] for table in output_tables}
+    records['vehicle_data'].append(pd.DataFrame({'v_id': np.flatnonzero(status == VACANT), 'is_HV': False,
+                                                 'neoclassical': None, 'income': 0.0, 'time': 0, 'activation': True}))
+    waiting = {True: np.zeros(0, dtype=int), False: np.zeros(0, dtype=int)}  # Waiting passengers of HV/AV
+    preferHV = np.full(len(df), None, dtype=object)
+    fare = np.zeros(len(df))
+
+    def drop_off(t, end=False):
+        nonlocal HV_total
+        done = np.flatnonzero((status == OCCUPIED) & (freeAt <= t))
+        ratio = occupiedTime[done] / np.maximum(freeAt[done] - tripStart[done], 1)
+        records['utilisation_data'].append(pd.DataFrame({'time': freeAt[done], 'v_id': done, 'trip_utilisation': ratio}))
+        tripStart[done] = freeAt[done]
+        status[done] = VACANT
+
+        # HVs decide whether to leave the labour market upon drop-off
+        h = done[isHV[done]]
+        occupied = np.array([HV_occupied.count(f) for f in freeAt[h]])
+        stay = (not end) & (freeAt[h] - joinAt[h] < maximumWork) & \
+            HV_continues(neo[h], hourlyCost[h], income[h], targetIncome[h], occupied, max(HV_total, 1))
+        leave = h[~stay]
+        status[leave] = EXITED
+        HV_total -= len(leave)
+        records['vehicle_data'].append(pd.DataFrame({'v_id': leave, 'is_HV': True, 'neoclassical': neo[leave],
+                                                     'income': income[leave], 'time': freeAt[leave], 'activation': False}))
+
+    # Vacant HVs leave the market when the maximum work duration is reached, as Supply.EndShift
+    def end_shift(t):
+        nonlocal HV_total
+        leave = np.flatnonzero(isHV & (status == VACANT) & (joinAt + maximumWork <= t))
+        status[leave] = EXITED
+        HV_total -= len(leave)
+        records['vehicle_data'].append(pd.DataFrame({'v_id': leave, 'is_HV': True, 'neoclassical': neo[leave],
+                                                     'income': income[leave], 'time': joinAt[leave] + maximumWork,
+                                                     'activation': False}))
+
+    def join(t):
+        nonlocal HV_total, firstTime
+        j = np.flatnonzero((status == PENDING) & isHV & (joinAt <= t))
+        if not len(j):
+            return
+        if HV_total > 0 and not firstTime:
+            expectedWage = Variables.unitWage * 3600 * HV_occupied.count(t) / HV_total
+        else:
+            expectedWage = Variables.unitWage * 3600 * 0.6
+            firstTime = False
+
+        joins = HV_joins(neo[j], hourlyCost[j], expectedWage)
+        retries = ~joins & neo[j] & (joinAt[j] + 300 < lastTime) & \
+            HV_retries(hourlyCost[j], expectedWage, np.random.rand(len(j)))
+        status[j[joins]] = VACANT
+        tripStart[j[joins]] = joinAt[j[joins]]
+        HV_total += joins.sum()
+        joinAt[j[retries]] += 300
+        status[j[~joins & ~retries]] = EXITED  # Neoclassical drivers who give up joining the market
+        records['vehicle_data'].append(pd.DataFrame({'v_id': j[joins], 'is_HV': True, 'neoclassical': neo[j[joins]],
+                                                     'income': 0.0, 'time': joinAt[j[joins]], 'activation': True}))
+
+    def choose(t, new):
+        # Phi and ETA to the nearest vacant vehicle (zone to zone) before creating new passengers
+        eta = {}
+        phi = {}
+        for fleet in (True, False):
+            vacant = (status == VACANT) & (isHV == fleet)
+            phi[fleet] = compute_phi(len(waiting[fleet]), vacant.sum())
+            vacantZones = np.unique(vZone[vacant])
+            eta[fleet] = travel[vacantZones].min(axis=0) if len(vacantZones) else np.full(len(travel), np.inf)
+
+        GC_HV = fare_HV[new] + pVoT[new] / 3600 * phi[True] * np.minimum(eta[True][pZone[new]], 1200)
+        GC_AV = fare_AV[new] + pVoT[new] / 3600 * phi[False] * np.minimum(eta[False][pZone[new]], 1200)
+        cumulative = np.cumsum(choice_probabilities(GC_HV, GC_AV), axis=0)
+        u = np.random.rand(len(new))
+        chooseHV = u < cumulative[0]
+        chooseAV = ~chooseHV & (u < cumulative[1])
+
+        preferHV[new[chooseHV]] = True
+        preferHV[new[chooseAV]] = False
+        fare[new[chooseHV]] = fare_HV[new[chooseHV]]
+        fare[new[chooseAV]] = fare_AV[new[chooseAV]]
+        waiting[True] = np.r_[waiting[True], new[chooseHV]]
+        waiting[False] = np.r_[waiting[False], new[chooseAV]]
+
+    def expire(t):
+        for fleet in (True, False):
+            expired = pExpire[waiting[fleet]] <= t
+            records['expiration_data'].append(pd.DataFrame({'p_id': waiting[fleet][expired],
+                                                            'expire_t': pExpire[waiting[fleet][expired]]}))
+            waiting[fleet] = waiting[fleet][~expired]
+
+    def match(t, fleet):
+        p = waiting[fleet]
+        v = np.flatnonzero((status == VACANT) & (isHV == fleet))
+        if not len(p) or not len(v):
+            return
+
+        # Passengers (first come, first served) are matched with vacant vehicles in the same zone
+        size = len(p) + len(v)
+        _, pi, vi = np.intersect1d(pZone[p] * size + zone_ranks(pZone[p]), vZone[v] * size + zone_ranks(vZone[v]),
+                                   assume_unique=True, return_indices=True)
+        matchedP = list(p[pi])
+        matchedV = list(v[vi])
+
+        # Remaining passengers are matched with vehicles in the nearest zones
+        restP = np.setdiff1d(p, matchedP, assume_unique=True)
+        restV = np.setdiff1d(v, matchedV, assume_unique=True)
+        restP = restP[np.argsort(pTime[restP], kind='stable')]
+        byZone = [list(restV[vZone[restV] == z]) for z in range(len(travel))]
+        available = np.array([len(b) > 0 for b in byZone])
+        for q in restP[:len(restV)]:
+            z = np.flatnonzero(available)[np.argmin(travel[available, pZone[q]])]
+            matchedP.append(q)
+            matchedV.append(byZone[z].pop())
+            available[z] = len(byZone[z]) > 0
+
+        matchedP = np.array(matchedP, dtype=int)
+        matchedV = np.array(matchedV, dtype=int)
+        meeting = t + np.rint(travel[vZone[matchedV], pZone[matchedP]])
+        delivery = meeting + pDuration[matchedP]
+
+        status[matchedV] = OCCUPIED
+        freeAt[matchedV] = delivery
+        occupiedTime[matchedV] = pDuration[matchedP]
+        vZone[matchedV] = pDest[matchedP]
+        if fleet:
+            income[matchedV] += Variables.unitWage * pDuration[matchedP]
+            for m, d in zip(meeting, delivery):
+                if m < lastTime:
+                    HV_occupied.add(m, 1)
+                if d < lastTime:
+                    HV_occupied.add(d, -1)
+        else:
+            income[matchedV] += fare[matchedP]
+        waiting[fleet] = np.setdiff1d(p, matchedP, assume_unique=True)
+        records['assignment_data'].append(pd.DataFrame({'v_id': matchedV, 'p_id': matchedP, 'dispatch_t': t,
+                                                        'meeting_t': meeting, 'delivery_t': delivery}))
+
+    start = 0
+    for t in range(0, int(lastTime) + step, step):
+        drop_off(t)
+        end_shift(t)
+        join(t)
+        end = np.searchsorted(pTime, t, side='right')
+        choose(t, np.arange(start, end))
+        start = end
+        expire(t)
+        match(t, True)
+        match(t, False)
+
+    # End of simulation: remaining trips are completed, HVs and AVs exit, and waiting passengers expire
+    drop_off(np.inf, end=True)
+    h = np.flatnonzero(isHV & (status == VACANT))
+    records['vehicle_data'].append(pd.DataFrame({'v_id': h, 'is_HV': True, 'neoclassical': neo[h], 'income': income[h],
+                                                 'time': lastTime, 'activation': False}))
+    expire(np.inf)
+
+    records['passenger_data'].append(pd.DataFrame({
+        'p_id': np.arange(len(df)), 'request_t': pTime, 'trip_d': df['trip_distance'], 'trip_t': pDuration, 'VoT': pVoT,
+        'fare': fare, 'prefer_HV': preferHV, 'o_source': df['o_source'], 'o_target': df['o_target'], 'o_loc': df['o_loc'],
+        'd_source': df['d_source'], 'd_target': df['d_target'], 'd_loc': df['d_loc'], 'patience': df['patience']}))
+    return {table: pd.concat(records[table], ignore_index=True) if records[table]
+            else pd.DataFrame(columns=list(output_tables[table])) for table in output_tables}
+
+
+def summary(tables):
+    return kpis(tables['passenger_data'], tables['expiration_data'], tables['assignment_data'],
+                tables['utilisation_data'], tables['vehicle_data'])
+
+
+# Hourly profile of served trips and expirations
+def hourly_profile(expirations, assignments):
+    hours = lambda t: (t // 3600).astype(int)
+    return pd.DataFrame({'served': assignments.groupby(hours(assignments['dispatch_t'])).size(),
+                         'expired': expirations.groupby(hours(expirations['expire_t'])).size()}).fillna(0)
+
+
+# Calibration report of mesoscopic KPIs against outputs of the detailed simulation, with the same passengers
+def calibrate(path, number, **kwargs):
+    detailed = compute_kpis(path, number)
+    _t0 = time.time()
+    tables = simulate(passengers=read_results(path, number, 'passenger_data'), **kwargs)
+    runtime = time.time() - _t0
+    mesoscopic = summary(tables)
+
+    report = pd.DataFrame({'detailed': detailed, 'mesoscopic': mesoscopic})
+    report['difference'] = report['mesoscopic'] - report['detailed']
+    report['relative'] = report['difference'] / report['detailed']
+
+    # Agreement of hourly profiles (correlation and mean absolute error)
+    profiles = hourly_profile(read_results(path, number, 'expiration_data'), read_results(path, number, 'assignment_data')
+                              ).join(hourly_profile(tables['expiration_data'], tables['assignment_data']),
+                                     how='outer', rsuffix='_meso').fillna(0)
+    for c in ('served', 'expired'):
+        report.loc['hourly_{}_correlation'.format(c), 'mesoscopic'] = profiles[c].corr(profiles[c + '_meso'])
+        report.loc['hourly_{}_MAE'.format(c), 'mesoscopic'] = (profiles[c] - profiles[c + '_meso']).abs().mean()
+    report.loc['runtime_sec', 'mesoscopic'] = runtime
+
+    report.to_csv('{}/sim{}_calibration.csv'.format(path, number))
+    return report
+
+
+if __name__ == '__main__':
+    if configs['random_seed'] is not None:
+        np.random.seed(configs['random_seed'])
+    if len(sys.argv) > 1:
+        print(calibrate(configs['data_output_path'], int(sys.argv[1])).to_string())
+    else:
+        _t0 = time.time()
+        print(summary(simulate()))
+        print('Mesoscopic simulation ended in: {:.1f} sec.'.format(time.time() - _t0))
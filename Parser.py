@@ -1,3 +1,4 @@
+import os
 import pandas as pd
 
 from Configuration import configs
@@ -7,18 +8,31 @@ depot_nodes = configs['depot_nodes']
 map_file = configs['map_file']
 
 
-def read_passengers(fraction, hours):
+# Daily trip files for multi-day simulations, sorted by file names (e.g. dates)
+def passenger_days(directory):
+    return [os.path.join(directory, f) for f in sorted(os.listdir(directory)) if f.endswith('.csv')]
+
+
+# Passenger request times (sec) are from the simulation start at 04:00, or from midnight of the trip file's day
+def read_passengers(fraction, hours, passenger_file=None, from_midnight=False):
     use_cols = ['tpep_pickup_datetime', 'o_source', 'o_target', 'o_loc', 'd_source', 'd_target', 'd_loc',
                 'trip_distance', 'trip_duration', 'patience', 'VoT']
-    passenger_df = pd.read_csv(configs["passenger_file"], usecols=use_cols)
+    passenger_df = pd.read_csv(passenger_file or configs["passenger_file"], usecols=use_cols)
     passenger_df['time'] = passenger_df['tpep_pickup_datetime']
-    passenger_df['time'] -= passenger_df['time'].min()
 
-    # Demand time shift, move 00:00 - 04:00 to the end of the day such that simulation starts at 04:00
-    passenger_df['time'] = (passenger_df['time'] + 20 * 3600) % (24 * 3600)
+    if from_midnight:
+        # Consecutive days of multi-day simulations keep 00:00 - 04:00 trips where they fall, the day is taken from
+        # the median request such that a few trips of adjacent days do not shift the whole file
+        passenger_df['time'] -= int(passenger_df['time'].median()) // (24 * 3600) * (24 * 3600)
+        passenger_df = passenger_df[(passenger_df['time'] >= 0) & (passenger_df['time'] < hours * 3600)]
+    else:
+        passenger_df['time'] -= passenger_df['time'].min()
+
+        # Demand time shift, move 00:00 - 04:00 to the end of the day such that simulation starts at 04:00
+        passenger_df['time'] = (passenger_df['time'] + 20 * 3600) % (24 * 3600)
 
-    # Limit daily demand to the specified hours
-    passenger_df = passenger_df[passenger_df['time'] <= hours * 3600]
+        # Limit daily demand to the specified hours
+        passenger_df = passenger_df[passenger_df['time'] <= hours * 3600]
 
     # print(passenger_df.dtypes)  # Print data types for debugging
 
@@ -0,0 +1,178 @@
+import os
+import sys
+import json
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+import pandas as pd
+from scipy.stats import t as student_t
+
+from Control import read_results
+
+
+# Replication manager for scenario comparisons with common random numbers (CRN).
+# Each replication runs every scenario with the same random seed (same driver attributes and demand sample),
+# and replications are added until the confidence intervals of KPI differences are tight enough.
+#
+# Usage: python Replication.py Study.json, where the study file is like
+# {
+#   "base": "Config.json",
+#   "output_path": "../Results/Replications",
+#   "scenarios": {"baseline": {}, "large_AV_fleet": {"AV_fleet_size": 1000}},
+#   "targets": {"expiration_rate": 0.005, "mean_pickup_time": 5},
+#   "confidence": 0.95,
+#   "min_replications": 3,
+#   "max_replications": 30,
+#   "workers": 4
+# }
+_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+# Key performance indicators of a simulation, computed from its output tables
+def compute_kpis(path, number):
+    return kpis(read_results(path, number, 'passenger_data'), read_results(path, number, 'expiration_data'),
+                read_results(path, number, 'assignment_data'), read_results(path, number, 'utilisation_data'),
+                read_results(path, number, 'vehicle_data'))
+
+
+def kpis(passengers, expirations, assignments, utilisation, vehicles):
+    requests = passengers['prefer_HV'].notna().sum()  # Passengers who chose HV or AV
+    pickup = assignments.merge(passengers[['p_id', 'request_t']], on='p_id')
+    utilisation = utilisation.merge(vehicles[['v_id', 'is_HV']].drop_duplicates('v_id'), on='v_id')
+    is_HV = utilisation['is_HV'].astype(bool)
+
+    return {'expiration_rate': len(expirations) / requests if requests else np.nan,
+            'mean_pickup_time': (pickup['meeting_t'] - pickup['request_t']).mean(),
+            'HV_utilisation': utilisation.loc[is_HV, 'trip_utilisation'].mean(),
+            'AV_utilisation': utilisation.loc[~is_HV, 'trip_utilisation'].mean(),
+            'served_trips': len(assignments)}
+
+
+class RunningStat:
+    """ Incremental mean and variance (Welford's algorithm) """
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def add(self, x):
+        if np.isnan(x):
+            return
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+
+    def half_width(self, confidence):
+        if self.n < 2:
+            return np.inf
+        return student_t.ppf((1 + confidence) / 2, self.n - 1) * np.sqrt(self.m2 / (self.n - 1) / self.n)
+
+
+# Passenger files are validated and the routing cache is built once for each distinct input of the scenarios,
+# before simulations run in parallel on the shared files
+def prepare_inputs(base, scenarios, path):
+    prepared = set()
+    for s, overrides in scenarios.items():
+        configs = base | overrides
+        inputs = tuple(json.dumps(configs.get(k)) for k in ('map_file', 'passenger_file', 'passenger_directory',
+                                                              'routing_cache', 'routing_landmarks'))
+        if inputs in prepared:
+            continue
+        prepared.add(inputs)
+
+        os.makedirs('{}/{}'.format(path, s), exist_ok=True)
+        config_file = '{}/{}/inputs_config.json'.format(path, s)
+        with open(config_file, 'w') as jsonFile:
+            json.dump(configs, jsonFile, indent=2)
+        with open('{}/{}/inputs_log.txt'.format(path, s), 'w') as log:
+            subprocess.run([sys.executable, '-c', 'import Basics; Basics.validate_inputs()'], cwd=_dir, stdout=log,
+                           stderr=subprocess.STDOUT, check=True,
+                           env=os.environ | {'MIXEDFLEET_CONFIG': os.path.abspath(config_file)})
+
+
+def run_simulation(base, overrides, seed, path):
+    os.makedirs(path, exist_ok=True)
+    configs = base | overrides | {'random_seed': seed, 'output_number': seed, 'data_output_path': path}
+    config_file = '{}/sim{}_config.json'.format(path, seed)
+    with open(config_file, 'w') as jsonFile:
+        json.dump(configs, jsonFile, indent=2)
+
+    # Each replication runs in a separate process, as simulation states are module-level
+    with open('{}/sim{}_log.txt'.format(path, seed), 'w') as log:
+        subprocess.run([sys.executable, 'Simulation.py'], cwd=_dir, stdout=log, stderr=subprocess.STDOUT, check=True,
+                       env=os.environ | {'MIXEDFLEET_CONFIG': os.path.abspath(config_file)})
+    return compute_kpis(path, seed)
+
+
+def run_study(study):
+    with open(os.path.join(_dir, study.get('base', 'Config.json')), 'r') as jsonFile:
+        base = json.load(jsonFile)
+    scenarios = study['scenarios']
+    reference = next(iter(scenarios))  # Differences are paired against the first scenario
+    targets = study['targets']
+    confidence = study.get('confidence', 0.95)
+    min_reps = study.get('min_replications', 3)
+    max_reps = study.get('max_replications', 30)
+    output_path = os.path.abspath(study['output_path'])
+    workers = study.get('workers', os.cpu_count())
+
+    stats = {(s, k): RunningStat() for s in scenarios for k in targets}
+    diffs = {(s, k): RunningStat() for s in scenarios if s != reference for k in targets}
+    results = {}  # {seed: {scenario: KPIs}}, kept until the replication of all scenarios is completed
+    records = []
+
+    def converged():
+        n = min((d.n for d in diffs.values()), default=min(st.n for st in stats.values()))
+        if n < min_reps:
+            return False
+        checked = diffs if diffs else stats
+        return all(checked[key].half_width(confidence) <= targets[key[1]] for key in checked)
+
+    prepare_inputs(base, scenarios, output_path)
+
+    seed = 0
+    running = {}
+    with ThreadPoolExecutor(workers) as pool:
+        while True:
+            # Keep the pool busy with whole replications, unless the stopping rule is met
+            while len(running) < workers and seed < max_reps and not converged():
+                for s in scenarios:
+                    running[pool.submit(run_simulation, base, scenarios[s], seed, '{}/{}'.format(output_path, s))] = (seed, s)
+                seed += 1
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for task in done:
+                r, s = running.pop(task)
+                results.setdefault(r, {})[s] = task.result()
+                if len(results[r]) < len(scenarios):
+                    continue
+
+                # Replication r is completed for all scenarios
+                kpis = results.pop(r)
+                for s in scenarios:
+                    records.append({'replication': r, 'scenario': s} | kpis[s])
+                    for k in targets:
+                        stats[s, k].add(kpis[s][k])
+                        if s != reference:
+                            diffs[s, k].add(kpis[s][k] - kpis[reference][k])
+                print('Replication {} completed, CI half-widths: {}'.format(r, {
+                    '{}-{}'.format(*key): round(float(d.half_width(confidence)), 4) for key, d in (diffs or stats).items()}))
+
+    summary = pd.DataFrame([{'scenario': s, 'kpi': k, 'replications': stats[s, k].n, 'mean': stats[s, k].mean,
+                             'half_width': stats[s, k].half_width(confidence),
+                             'difference': diffs[s, k].mean if s != reference else 0.0,
+                             'difference_half_width': diffs[s, k].half_width(confidence) if s != reference else 0.0}
+                            for s in scenarios for k in targets])
+    pd.DataFrame(records).to_csv('{}/replications.csv'.format(output_path), index=False)
+    summary.to_csv('{}/summary.csv'.format(output_path), index=False)
+    print('Study {} after {} replications.'.format('converged' if converged() else 'stopped', len(records) // len(scenarios)))
+    return summary
+
+
+if __name__ == '__main__':
+    with open(sys.argv[1], 'r') as studyFile:
+        print(run_study(json.load(studyFile)).to_string(index=False))
@@ -0,0 +1,179 @@
+import os
+import heapq
+import hashlib
+from functools import lru_cache
+import numpy as np
+import networkx as nx
+from scipy.sparse import csr_matrix, csgraph
+
+from Configuration import configs
+from Map import G
+
+
+# ALT routing engine (A* search with Landmarks and Triangle inequality) on the road network G.
+# Memory is linear in graph size: a compact adjacency of G plus 2 distance vectors per landmark,
+# instead of an all-pairs matrix which does not scale beyond the Manhattan network.
+landmark_size = configs['routing_landmarks']
+cache_file = configs['routing_cache']
+
+nodes = list(G.nodes)
+node_index = {n: i for i, n in enumerate(nodes)}
+
+
+# Compressed sparse row adjacency (duration weights) of a directed graph, aligned with node_index
+def compress(graph):
+    indptr = [0]
+    indices = []
+    weights = []
+    for n in nodes:
+        for m, attr in graph.adj[n].items():
+            indices.append(node_index[m])
+            weights.append(attr['duration'])
+        indptr.append(len(indices))
+    return indptr, indices, weights
+
+
+forward = compress(G)
+backward = compress(G.reverse(copy=False))
+
+
+# One-to-all Dijkstra on a compressed graph, unreachable nodes are kept as infinity
+def dijkstra(csr, source):
+    indptr, indices, weights = csr
+    dist = [float('inf')] * len(nodes)
+    dist[source] = 0
+    heap = [(0, source)]
+    while heap:
+        d, u = heapq.heappop(heap)
+        if d > dist[u]:
+            continue
+        for k in range(indptr[u], indptr[u + 1]):
+            v = indices[k]
+            if d + weights[k] < dist[v]:
+                dist[v] = d + weights[k]
+                heapq.heappush(heap, (dist[v], v))
+    return np.array(dist)
+
+
+# Farthest-first landmark selection, which spreads landmarks towards the boundary of the network
+def select_landmarks(size):
+    start = dijkstra(forward, 0)
+    landmarks = [int(np.argmax(np.where(np.isinf(start), -1, start)))]
+    dist_from = [dijkstra(forward, landmarks[0])]
+    dist_to = [dijkstra(backward, landmarks[0])]
+    while len(landmarks) < min(size, len(nodes)):
+        reach = np.minimum.reduce([np.where(np.isinf(d), 0, d) for d in dist_from + dist_to])
+        reach[landmarks] = -1
+        landmarks.append(int(np.argmax(reach)))
+        dist_from.append(dijkstra(forward, landmarks[-1]))
+        dist_to.append(dijkstra(backward, landmarks[-1]))
+    return np.array(landmarks), np.array(dist_from), np.array(dist_to)
+
+
+# Fingerprint of the compressed graphs, such that cached landmark distances are only reused for the same durations
+def graph_hash():
+    digest = hashlib.sha1()
+    for csr in (forward, backward):
+        digest.update(np.asarray(csr[0], dtype=np.int64).tobytes())
+        digest.update(np.asarray(csr[1], dtype=np.int64).tobytes())
+        digest.update(np.asarray(csr[2], dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+
+# Landmark preprocessing is cached to disk, and recomputed if the network nodes, edges or durations have changed
+def load_landmarks():
+    graph = graph_hash()
+    if cache_file and os.path.exists(cache_file):
+        cached = np.load(cache_file)
+        if len(cached['landmarks']) == landmark_size and np.array_equal(cached['nodes'], nodes) and \
+                'graph' in cached and cached['graph'] == graph:
+            return cached['landmarks'], cached['dist_from'], cached['dist_to']
+
+    print('Preprocessing {} routing landmarks...'.format(landmark_size))
+    landmarks, dist_from, dist_to = select_landmarks(landmark_size)
+    if cache_file:
+        # Written to a temporary file and then renamed, such that concurrent simulations never read a partial cache
+        temp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+        with open(temp_file, 'wb') as f:
+            np.savez_compressed(f, nodes=nodes, graph=graph, landmarks=landmarks, dist_from=dist_from, dist_to=dist_to)
+        os.replace(temp_file, cache_file)
+    return landmarks, dist_from, dist_to
+
+
+landmarks, dist_from, dist_to = load_landmarks()
+
+
+# Landmark distances by node (nodes x landmarks). Unreachable distances are replaced by a large constant, which keeps
+# bounds admissible: a bound can only become large for nodes that cannot reach the target
+unreachable = 1e12
+node_from = np.ascontiguousarray(np.nan_to_num(dist_from.T, posinf=unreachable))
+node_to = np.ascontiguousarray(np.nan_to_num(dist_to.T, posinf=unreachable))
+
+
+# Lower bounds of the travel time from all nodes to target t, by the triangle inequality on each landmark.
+# Queries in a matching round share passenger origins as targets, so bounds of a few recent targets are kept as float32,
+# rounded down such that they remain admissible.
+@lru_cache(maxsize=64)
+def lower_bounds(t):
+    bounds = np.maximum((node_from[t] - node_from).max(axis=1), (node_to - node_to[t]).max(axis=1)).clip(min=0)
+    rounded = bounds.astype(np.float32)
+    return np.where(rounded > bounds, np.nextafter(rounded, np.float32(0)), rounded)
+
+
+def astar(s, t):
+    indptr, indices, weights = forward
+    h = lower_bounds(t)
+    cost = {s: 0}
+    previous = {s: None}
+    settled = set()
+    heap = [(h[s], s)]
+    while heap:
+        _, u = heapq.heappop(heap)
+        if u == t:
+            return cost[t], previous
+        if u in settled:
+            continue
+        settled.add(u)
+        for k in range(indptr[u], indptr[u + 1]):
+            v = indices[k]
+            c = cost[u] + weights[k]
+            if c < cost.get(v, float('inf')):
+                cost[v] = c
+                previous[v] = u
+                heapq.heappush(heap, (c + h[v], v))
+    raise nx.NetworkXNoPath('No path between {} and {}.'.format(nodes[s], nodes[t]))
+
+
+# Shortest travel times from many sources to many targets (intersections), unreachable pairs are kept as infinity.
+# Matching rounds query all vehicle-passenger pairs at once: one compiled Dijkstra search per distinct target (on the
+# reversed graph) or per distinct source, whichever is fewer. A search reaches all nodes of the Manhattan network in
+# about 1 ms, i.e. a few microseconds per pair in rounds with hundreds of vehicles, while a single A* query takes
+# about 1-2 ms in pure Python and is kept for trips and paths which are queried one at a time.
+forward_matrix = csr_matrix((forward[2], forward[1], forward[0]), shape=(len(nodes), len(nodes)), dtype=float)
+backward_matrix = csr_matrix((backward[2], backward[1], backward[0]), shape=(len(nodes), len(nodes)), dtype=float)
+
+
+def duration_matrix(sources, targets):
+    s = np.array([node_index[n] for n in sources], dtype=int)
+    t = np.array([node_index[n] for n in targets], dtype=int)
+    if len(set(sources)) <= len(set(targets)):
+        searched, inverse = np.unique(s, return_inverse=True)
+        return csgraph.dijkstra(forward_matrix, indices=searched)[inverse][:, t]
+    searched, inverse = np.unique(t, return_inverse=True)
+    return csgraph.dijkstra(backward_matrix, indices=searched)[inverse][:, s].T
+
+
+# Shortest travel time between 2 intersections, repeated vehicle-passenger pairs are answered from memory
+@lru_cache(maxsize=configs['routing_memory'])
+def shortest_duration(source, target):
+    return astar(node_index[source], node_index[target])[0]
+
+
+# Shortest path between 2 intersections, unpacked from A* predecessors
+def shortest_path(source, target):
+    t = node_index[target]
+    _, previous = astar(node_index[source], t)
+    path = [t]
+    while previous[path[-1]] is not None:
+        path.append(previous[path[-1]])
+    return [nodes[i] for i in reversed(path)]
@@ -0,0 +1,265 @@
+import sys
+import json
+import time
+import heapq
+import asyncio
+from collections import deque
+import numpy as np
+import pandas as pd
+import networkx as nx
+
+from Configuration import configs
+from Map import G
+from Basics import eventQueue, Location, distance_between, duration_between
+from Control import Statistics, write_results
+from Supply import load_vehicles, HVs, activeAVs
+from Demand import NewPassenger, UpdatePhi
+from Management import Assign
+
+
+# Real-time service mode: the dispatch logic runs as a shadow dispatcher for live ride requests.
+# Simulation time follows the wall clock (or faster by service_speed), and requests are JSON lines over a local socket:
+#   request : {"id": 1, "o": [source, target, loc], "d": [source, target, loc], "patience": 60, "VoT": 32}
+#   response: {"id": 1, "status": "assigned", "p_id": 0, "v_id": 5, "is_HV": true, "fare": 9.4,
+#              "meeting_t": 14420, "delivery_t": 15030, "latency": 0.0123}
+#             status is one of assigned, expired, declined (prefers other modes), busy (queue is full), error, or
+#             shutdown (the service ended before the request was matched)
+#   {"cmd": "stats"} responds with latency metrics per request and per matching round
+#
+# Usage: python Service.py                          (serve at service_address)
+#        python Service.py client [rate] [requests]  (load generator with passenger_file trips)
+def parse_address(address):
+    if address.startswith('unix:'):
+        return address[5:], None
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+# Location of a request as [source], [source, target] or [source, target, location from source], checked against G
+def parse_location(values):
+    if not 1 <= len(values) <= 3:
+        raise ValueError('Location {} must be [source, target, location from source].'.format(values))
+    source, target, loc = list(values) + [None, 0][len(values) - 1:]
+    if source not in G.nodes or (target is not None and not G.has_edge(source, target)):
+        raise ValueError('Location {} is not on the road network.'.format(values))
+    if target is not None and not 0 <= loc <= G.edges[source, target]['distance']:
+        raise ValueError('Location {} is beyond the road length.'.format(values))
+    return Location(source, target, loc)
+
+
+def percentiles(values):
+    if not values:
+        return {'count': 0}
+    values = np.array(values)
+    return {'count': len(values), 'mean': float(values.mean()), 'p50': float(np.percentile(values, 50)),
+            'p95': float(np.percentile(values, 95)), 'max': float(values.max())}
+
+
+class DispatchService:
+    def __init__(self):
+        self.speed = configs['service_speed']
+        self.startTime = configs['service_start_time']
+        self.endTime = self.startTime + configs['service_duration']
+        self.now = self.startTime
+        self.requests = asyncio.Queue(maxsize=configs['service_queue_size'])  # Backpressure on incoming requests
+        self.pending = {}  # {p_id: ((request id, stream writer, received wall time), prefer HV, fare)}
+        self.newRequests = {}  # {NewPassenger event: (request id, stream writer, received wall time)}
+        self.assignmentIndex = 0
+        self.expirationIndex = 0
+        self.closed = False
+
+        # Latency metrics (sec) of recent requests and matching rounds
+        self.requestLatency = deque(maxlen=10000)
+        self.roundLatency = deque(maxlen=10000)
+        self.lag = 0  # Wall clock lag of simulation time (sec)
+        self.busy = 0
+
+        load_vehicles()
+        Statistics.lastPassengerTime = self.endTime
+        Assign(self.startTime)
+        self.step(self.startTime)  # Catch up with the start time, e.g. HV shifts and AV activation
+
+    def respond(self, request, response):
+        rid, writer, received = request
+        if received is not None:
+            response['latency'] = time.perf_counter() - received
+            self.requestLatency.append(response['latency'])
+        try:
+            writer.write((json.dumps({'id': rid} | response) + '\n').encode())
+        except (ConnectionError, RuntimeError):
+            pass  # The client has disconnected
+
+    def new_request(self, message, writer):
+        received = time.perf_counter()
+        rid = None
+        try:
+            request = json.loads(message)
+            rid = request.get('id')
+            if request.get('cmd') == 'stats':
+                self.respond((rid, writer, None), self.stats())
+                return
+            origin = parse_location(request['o'])
+            destination = parse_location(request['d'])
+        except (ValueError, KeyError, TypeError, AttributeError) as e:  # Invalid requests are answered, not queued
+            self.respond((rid, writer, None), {'status': 'error', 'message': str(e)})
+            return
+
+        if self.closed:
+            self.respond((rid, writer, received), {'status': 'shutdown'})
+            return
+        try:
+            self.requests.put_nowait((request, origin, destination, (rid, writer, received)))
+        except asyncio.QueueFull:
+            self.busy += 1
+            self.respond((rid, writer, received), {'status': 'busy'})
+
+    def create_passengers(self, t):
+        # Requests become passenger events at the current simulation time
+        while not self.requests.empty():
+            request, origin, destination, requester = self.requests.get_nowait()
+            try:
+                distance = distance_between(origin, destination)
+                duration = duration_between(origin, destination)
+            except (nx.NetworkXNoPath, KeyError) as e:  # The request is answered, the service continues
+                self.respond(requester, {'status': 'error', 'message': 'No route: {}'.format(e)})
+                continue
+
+            UpdatePhi(t)
+            event = NewPassenger(t, origin, destination, distance, duration, request.get('patience', 60),
+                                 request.get('VoT', 32))
+            self.newRequests[event] = requester
+
+    def step(self, t):
+        while len(eventQueue) != 0 and eventQueue[0].time <= t:
+            event = heapq.heappop(eventQueue)
+            if isinstance(event, UpdatePhi):
+                event.trigger(len(HVs), len(activeAVs))
+            elif isinstance(event, NewPassenger):
+                p = event.trigger()
+                requester = self.newRequests.pop(event, None)
+                if requester is None:
+                    continue
+                if p.preferHV is None:
+                    self.respond(requester, {'status': 'declined', 'p_id': p.id})
+                else:
+                    self.pending[p.id] = (requester, p.preferHV, p.fare)
+            elif isinstance(event, Assign):
+                _t0 = time.perf_counter()
+                event.trigger()
+                self.roundLatency.append(time.perf_counter() - _t0)
+                self.respond_assignments()
+                if event.time + configs['match_interval'] <= self.endTime:
+                    Assign(event.time + configs['match_interval'])
+            else:
+                event.trigger()
+
+    def respond_assignments(self):
+        for v_id, p_id, dispatch_t, meeting_t, delivery_t in Statistics.assignment_data[self.assignmentIndex:]:
+            if p_id in self.pending:
+                requester, is_HV, fare = self.pending.pop(p_id)
+                self.respond(requester, {'status': 'assigned', 'p_id': p_id, 'v_id': v_id, 'is_HV': is_HV, 'fare': fare,
+                                         'meeting_t': int(meeting_t), 'delivery_t': int(delivery_t)})
+        self.assignmentIndex = len(Statistics.assignment_data)
+
+        for p_id, expire_t in Statistics.expiration_data[self.expirationIndex:]:
+            if p_id in self.pending:
+                self.respond(self.pending.pop(p_id)[0], {'status': 'expired', 'p_id': p_id, 'expire_t': int(expire_t)})
+        self.expirationIndex = len(Statistics.expiration_data)
+
+    def shutdown(self):
+        # Requests which are still queued or waiting for a match at the end of the service are answered as well,
+        # such that clients waiting for one response per request do not hang
+        self.closed = True
+        while not self.requests.empty():
+            self.respond(self.requests.get_nowait()[3], {'status': 'shutdown'})
+        for requester in self.newRequests.values():
+            self.respond(requester, {'status': 'shutdown'})
+        self.newRequests.clear()
+        for p_id, (requester, _, _) in self.pending.items():
+            self.respond(requester, {'status': 'shutdown', 'p_id': p_id})
+        self.pending.clear()
+
+    def stats(self):
+        return {'status': 'stats', 'time': self.now, 'lag': self.lag, 'queued': self.requests.qsize(),
+                'pending': len(self.pending), 'busy': self.busy, 'vacant_HVs': len(HVs), 'vacant_AVs': len(activeAVs),
+                'request_latency': percentiles(self.requestLatency), 'round_latency': percentiles(self.roundLatency)}
+
+    async def handle(self, reader, writer):
+        while line := await reader.readline():
+            self.new_request(line, writer)
+            await writer.drain()
+
+    async def run_clock(self):
+        loop = asyncio.get_running_loop()
+        wall0 = loop.time()
+        while self.now < self.endTime:
+            target = self.startTime + (loop.time() - wall0) * self.speed
+            self.now = min(self.endTime, int(target))
+            self.create_passengers(self.now)
+            self.step(self.now)
+
+            # Wall clock time by which the simulation falls behind, after processing the current time
+            self.lag = max(0.0, self.startTime + (loop.time() - wall0) * self.speed - self.now - 1) / self.speed
+            await asyncio.sleep(0.01)
+
+    async def serve(self, address):
+        host, port = parse_address(address)
+        if port is None:
+            server = await asyncio.start_unix_server(self.handle, host)
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+
+        print('Dispatch service at {} from time {} (x{} speed).'.format(address, self.startTime, self.speed))
+        async with server:
+            await self.run_clock()
+            self.shutdown()
+            await asyncio.sleep(0.1)  # Hand over the last responses to connected clients
+        print(self.stats())
+        write_results(configs['data_output_path'], configs['output_number'])
+
+
+# Local load generator, sending passenger_file trips as Poisson arrivals at rate (requests per sec)
+async def load_generator(address, rate=10.0, size=1000):
+    host, port = parse_address(address)
+    if port is None:
+        reader, writer = await asyncio.open_unix_connection(host)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+
+    trips = pd.read_csv(configs['passenger_file'], nrows=size)
+    sent = {}
+    responses = []
+
+    async def receive():
+        while len(responses) < len(trips) and (line := await reader.readline()):
+            response = json.loads(line)
+            response['client_latency'] = time.perf_counter() - sent[response['id']]
+            responses.append(response)
+
+    receiver = asyncio.create_task(receive())
+    for i, p in enumerate(trips.itertuples()):
+        request = {'id': i, 'o': [p.o_source, p.o_target, p.o_loc], 'd': [p.d_source, p.d_target, p.d_loc]}
+        if 'patience' in trips.columns:
+            request |= {'patience': int(p.patience), 'VoT': float(p.VoT)}
+        sent[i] = time.perf_counter()
+        writer.write((json.dumps(request) + '\n').encode())
+        await writer.drain()
+        await asyncio.sleep(np.random.exponential(1 / rate))
+    await receiver
+
+    writer.write((json.dumps({'id': -1, 'cmd': 'stats'}) + '\n').encode())
+    if line := await reader.readline():  # No stats if the service has already ended
+        print(json.loads(line))
+    writer.close()
+
+    df = pd.DataFrame(responses)
+    print(df['status'].value_counts().to_dict())
+    print('Client latency (sec):', percentiles(df['client_latency'].tolist()))
+    return df
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'client':
+        asyncio.run(load_generator(configs['service_address'], *map(float, sys.argv[2:3]), *map(int, sys.argv[3:4])))
+    else:
+        asyncio.run(DispatchService().serve(configs['service_address']))
@@ -1,56 +1,113 @@
 import time
 import heapq
+import numpy as np
 
 from Configuration import configs
+from Parser import passenger_days
 from Basics import eventQueue, validate_passengers
-from Control import Statistics, set_wage, write_results
-from Supply import load_vehicles, HVs, activeAVs, DeactivateAVs, TripCompletion
-from Demand import load_passengers, NewPassenger, UpdatePhi, Passenger
-from Management import schedule_assignment
+from Control import Statistics, set_wage, write_results, ResultWriter
+from Supply import load_vehicles, load_HVs, HVs, activeAVs, DeactivateAVs, TripCompletion, EndShift
+from Demand import load_passengers, UpdatePhi, Passenger
+from Management import schedule_assignment, Assign
+
+
+# Execute event queue, sorted by Time and Priority, until the end time (exclusive) or all events are completed
+def run_events(endTime=None):
+    while len(eventQueue) != 0 and (endTime is None or eventQueue[0].time < endTime):
+        event = heapq.heappop(eventQueue)
+
+        # if event.time == 9 * 3600:
+        #     set_wage(45 / 3600)
+        # elif event.time == 11 * 3600:
+        #     set_wage(40 / 3600)
+        # elif event.time == 14 * 3600:
+        #     set_wage(60 / 3600)
+
+        if event.time <= Statistics.lastPassengerTime:
+            if isinstance(event, UpdatePhi):
+                event.trigger(len(HVs), len(activeAVs))
+            else:
+                event.trigger()
+
+            if writer and isinstance(event, Assign):
+                writer.flush()  # Hand over tables which have reached a full batch after each assignment round
+        else:  # Clear remaining passengers and vehicles
+            if len(HVs) != 0:
+                for _v in HVs.values():  # All vacant HVs force exit the market
+                    _v.decide_exit(event.time, end=True)
+                HVs.clear()
+            if isinstance(event, EndShift):
+                continue  # Shifts ending after the last passenger are covered by the forced exits
+
+            assert isinstance(event, TripCompletion), 'Overdue events should be TripCompletion'
+            event.trigger(end=True)  # All occupied HVs force exit the market after drop-off
+            Statistics.simulationEndTime = event.time
+
+
+# Common random numbers: vehicles, passengers and simulation dynamics use separately seeded random streams,
+# such that scenarios with the same seed share the same driver attributes and demand sample
+def seed_stream(stream):
+    if seed is not None:
+        np.random.seed([seed, stream])
 
 
 _t0 = time.time()
 
+seed = configs['random_seed']
+seed_stream(0)
+
+# Stream outputs to disk during the simulation, or write all outputs after the simulation
+# Multi-day simulations always stream outputs, such that memory does not grow with the number of days
+writer = None
+if configs['stream_output'] or configs['passenger_directory']:
+    writer = ResultWriter(configs['data_output_path'], configs['output_number'],
+                          configs['stream_output'] or 'csv', configs['stream_queue_size'], configs['stream_batch_rows'])
+
 # Load vehicles into Events
 # - HVs are randomly located, join the market based on their (1) neoclassical (2) income-targeting behaviours
 # - AVs are inactive at pre-defined depots, with an active initial fleet at 04:00
 load_vehicles()
 
-# Load passengers into Events
-validate_passengers(configs["passenger_file"])
-load_passengers(0.25)
-print('Last passenger spawns at {} sec.'.format(Statistics.lastPassengerTime))
-
-# Schedule assignments into Events
-schedule_assignment(Statistics.lastPassengerTime)
-
-while len(eventQueue) != 0:
-    event = heapq.heappop(eventQueue)
-
-    # if event.time == 9 * 3600:
-    #     set_wage(45 / 3600)
-    # elif event.time == 11 * 3600:
-    #     set_wage(40 / 3600)
-    # elif event.time == 14 * 3600:
-    #     set_wage(60 / 3600)
-
-    if event.time <= Statistics.lastPassengerTime:
-        # Execute event queue, sorted by Time and Priority
-        if isinstance(event, UpdatePhi):
-            event.trigger(len(HVs), len(activeAVs))
-        elif isinstance(event, NewPassenger):
-            event.trigger(HVs.values(), activeAVs.values())
-        else:
-            event.trigger()
-    else:  # Clear remaining passengers and vehicles
-        if len(HVs) != 0:
-            for _v in HVs.values():  # All vacant HVs force exit the market
-                _v.decide_exit(event.time, end=True)
-            HVs.clear()
-
-        assert isinstance(event, TripCompletion), 'Overdue events should be TripCompletion'
-        event.trigger(end=True)  # All occupied HVs force exit the market after drop-off
-        Statistics.simulationEndTime = event.time
+if configs['passenger_directory']:
+    # Multi-day simulation: daily trip files are loaded one day at a time, and vehicle states continue over days.
+    # The simulation starts at 04:00 of the first day, and trips are placed at their time from midnight of their day,
+    # such that 00:00 - 04:00 trips of a day fall at the end of the previous simulated day. Each file is loaded at
+    # midnight of its day (before the first file's 04:00 trips), together with a new cohort of HVs for the day.
+    days = passenger_days(configs['passenger_directory'])
+    roundEndTime = -configs['match_interval']
+    for day, passenger_file in enumerate(days):
+        offset = day * 24 * 3600
+        if day > 0:
+            seed_stream(3 * day)
+            load_HVs(offset)
+
+        validate_passengers(passenger_file)
+        seed_stream(3 * day + 1)
+        load_passengers(0.25, 24, passenger_file, offset - 4 * 3600, from_midnight=True)
+        print('Day {}: last passenger spawns at {} sec.'.format(day, Statistics.lastPassengerTime))
+
+        # Assignment rounds continue from the last round of the previous day
+        schedule_assignment(Statistics.lastPassengerTime, max(offset - 4 * 3600, roundEndTime + configs['match_interval']))
+        roundEndTime = Statistics.lastPassengerTime
+        seed_stream(3 * day + 2)
+        if day < len(days) - 1:
+            # Vehicles are not cleared before the last day, trips may continue after midnight
+            Statistics.lastPassengerTime = len(days) * 24 * 3600
+            run_events(offset + 20 * 3600)
+            writer.flush(force=True)
+            print('Day {} completed in: {:4d} sec.'.format(day, int(time.time() - _t0)))
+else:
+    # Load passengers into Events
+    validate_passengers(configs["passenger_file"])
+    seed_stream(1)
+    load_passengers(0.25)
+    print('Last passenger spawns at {} sec.'.format(Statistics.lastPassengerTime))
+
+    # Schedule assignments into Events
+    schedule_assignment(Statistics.lastPassengerTime)
+    seed_stream(2)
+
+run_events()
 
 # Deactivate all remaining (active) AVs
 DeactivateAVs(Statistics.simulationEndTime, len(activeAVs)).trigger()
@@ -60,5 +117,8 @@ for p in (Passenger.p_HV | Passenger.p_AV).values():
     p.check_expiration(999999)
 
 # Output relevant results
-write_results(configs['data_output_path'], configs['output_number'])
+if writer:
+    writer.close()
+else:
+    write_results(configs['data_output_path'], configs['output_number'])
 print('Simulation ended in: {:4d} sec.'.format(int(time.time() - _t0)))
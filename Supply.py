@@ -4,6 +4,7 @@ from scipy.stats import truncnorm
 
 from Configuration import configs
 from Parser import depot_nodes
+from Routing import duration_matrix
 from Basics import Event, Location, random_loc, duration_between
 from Control import Variables, Statistics
 
@@ -17,16 +18,91 @@ cruiseAV = configs['AV_cruise_mode']
 depot_dict = {Location(d): None for d in depot_nodes}
 
 
+class Fleet:
+    """ Registry of vehicle states in arrays indexed by vehicle id
+
+        status          : VACANT, OCCUPIED, INACTIVE (AVs at depots) or EXITED (HVs left the labour market)
+        source, target  : road of the current (or planned drop-off) location, backing Vehicle.loc
+        fromSource      : travel time from the source intersection to the location
+        toTarget        : travel time from the location to the target intersection
+        time            : vehicle time, backing Vehicle.time
+
+        Matching and ETA queries take vacant vehicles from the registry, in the order of ids.
+    """
+
+    VACANT, OCCUPIED, INACTIVE, EXITED = 0, 1, 2, 3
+
+    size = 0
+    vehicles = []
+    status = np.full(configs['HV_fleet_size'] + configs['AV_fleet_size'], EXITED, dtype=np.int8)
+    is_HV = np.zeros(len(status), dtype=bool)
+    source = np.zeros(len(status), dtype=np.int64)
+    target = np.zeros(len(status), dtype=np.int64)
+    fromSource = np.zeros(len(status))
+    toTarget = np.zeros(len(status))
+    time = np.zeros(len(status), dtype=np.int64)
+
+    @staticmethod
+    def register(vehicle):
+        assert vehicle.id == Fleet.size, 'Vehicles must be registered in the order of ids.'
+        if Fleet.size == len(Fleet.status):  # Double the capacity when the registry is full
+            Fleet.status = np.append(Fleet.status, np.full(Fleet.size, Fleet.EXITED, dtype=np.int8))
+            Fleet.is_HV = np.append(Fleet.is_HV, np.zeros(Fleet.size, dtype=bool))
+            Fleet.source = np.append(Fleet.source, np.zeros(Fleet.size, dtype=np.int64))
+            Fleet.target = np.append(Fleet.target, np.zeros(Fleet.size, dtype=np.int64))
+            Fleet.fromSource = np.append(Fleet.fromSource, np.zeros(Fleet.size))
+            Fleet.toTarget = np.append(Fleet.toTarget, np.zeros(Fleet.size))
+            Fleet.time = np.append(Fleet.time, np.zeros(Fleet.size, dtype=np.int64))
+        Fleet.vehicles.append(vehicle)
+        Fleet.size += 1
+
+    @staticmethod
+    def update(vehicle, status):
+        Fleet.status[vehicle.id] = status
+        if status == Fleet.EXITED:
+            Fleet.vehicles[vehicle.id] = None  # Exited HVs are no longer referenced by the registry
+
+    @staticmethod
+    def vacant(is_HV):
+        return np.flatnonzero((Fleet.status[:Fleet.size] == Fleet.VACANT) & (Fleet.is_HV[:Fleet.size] == is_HV))
+
+    @staticmethod
+    def vacant_vehicles(is_HV):
+        return [Fleet.vehicles[i] for i in Fleet.vacant(is_HV)]
+
+    # Travel time from the nearest vacant vehicle to loc, the same as the minimum of Basics.duration_between() over
+    # vacant vehicles, with one batched search from the source of loc on the reversed graph
+    @staticmethod
+    def nearest_time(is_HV, loc):
+        v = Fleet.vacant(is_HV)
+        if not len(v):
+            return float('inf')
+
+        # Vehicles upstream on the same road reach loc directly
+        same = (Fleet.source[v] == loc.source) & (Fleet.target[v] == loc.target) & \
+               (Fleet.fromSource[v] < loc.timeFromSource)
+        nearest = (loc.timeFromSource - Fleet.fromSource[v][same]).min(initial=float('inf'))
+
+        # Other vehicles drive to their target intersection, then take the shortest path to the source of loc
+        order = np.argsort(Fleet.target[v], kind='stable')
+        targets, first = np.unique(Fleet.target[v][order], return_index=True)
+        toTarget = np.minimum.reduceat(Fleet.toTarget[v][order], first)
+        viaTarget = toTarget + duration_matrix(targets.tolist(), [loc.source])[:, 0] + loc.timeFromSource
+        return min(nearest, viaTarget.min().item())
+
+    @staticmethod
+    def update_vacant_time(t):
+        Fleet.time[:Fleet.size][Fleet.status[:Fleet.size] == Fleet.VACANT] = t
+
+
 def load_vehicles():
-    # Instantiate the total AV fleet as inactive at depots (chosen randomly)
-    for d in np.random.choice(depot_nodes, configs['AV_fleet_size']):
-        AV(0, Location(d))
+    # AVs are loaded after HVs, such that HV attributes do not depend on the AV fleet size for the same random seed
+    load_HVs()
+    load_AVs()
 
-    # Activate random AVs as the initial fleet
-    ActivateAVs(0, configs['AV_initial_size'])
 
-    # Load HVs (neoclassical or income-targeting) with preferred shift start time and duration
-    total = configs['HV_fleet_size']
+# HV attributes (neoclassical or income-targeting) with preferred shift start time and duration
+def HV_attributes(total):
     morning = int(0.35 * total)
     afternoon = int(0.3 * total)
     evening = total - morning - afternoon
@@ -43,9 +119,43 @@ def load_vehicles():
     # hourlyCost = list(np.random.uniform(20, 60, total))
     hourlyCost = list(truncnorm.rvs(a=-0.5, b=3, loc=20, scale=10, size=total))
     targetIncome = list(np.random.uniform(50, 300, total))
+    return shift_start, neoList, hourlyCost, targetIncome
 
+
+# HVs join with preferred shift start times of the day, offset by (day * 86400) in multi-day simulations
+def load_HVs(offset=0):
+    total = configs['HV_fleet_size']
+    shift_start, neoList, hourlyCost, targetIncome = HV_attributes(total)
     for i in range(total):
-        NewHV(shift_start[i], random_loc(), neoList[i], hourlyCost[i], targetIncome[i])
+        NewHV(offset + shift_start[i], random_loc(), neoList[i], hourlyCost[i], targetIncome[i])
+
+
+def load_AVs():
+    # Instantiate the total AV fleet as inactive at depots (chosen randomly)
+    for d in np.random.choice(depot_nodes, configs['AV_fleet_size']):
+        AV(0, Location(d))
+
+    # Activate random AVs as the initial fleet
+    ActivateAVs(0, configs['AV_initial_size'])
+
+
+# HV labour supply rules, of drivers or arrays of driver attributes
+# Income-targeting drivers always start work to make an income
+# Neoclassical drivers start work if expected revenue >= hourly cost at start times
+def HV_joins(neo, hourlyCost, expectedWage):
+    return ~np.asarray(neo, dtype=bool) | (expectedWage >= hourlyCost)
+
+
+# Neoclassical drivers who do not join may try again later with binary Logit choice, given a uniform random number u
+def HV_retries(hourlyCost, expectedWage, u):
+    return (hourlyCost - expectedWage) / hourlyCost < u
+
+
+# Neoclassical drivers continue to work if current unit wage >= unit cost
+# Income-targeting drivers continue to work if accumulated income < target income
+def HV_continues(neo, hourlyCost, income, targetIncome, occupied, total):
+    neo = np.asarray(neo, dtype=bool)
+    return (neo & (Variables.unitWage * occupied / total * 3600 >= hourlyCost)) | (~neo & (income < targetIncome))
 
 
 class Vehicle:
@@ -53,6 +163,7 @@ class Vehicle:
 
     def __init__(self, time, loc):
         self.id = next(self._ids)
+        Fleet.register(self)
         self.time = time
         self.loc = loc
         self.is_HV = None
@@ -67,6 +178,26 @@ class Vehicle:
         # self.pathNodes = None  # Path from Basics.path_between(), including the upstream intersection as the first node
         # self.pathTimes = None  # Timestamps to reach path nodes, the first timestamp is the current time
 
+    @property
+    def time(self):
+        return Fleet.time[self.id].item()
+
+    @time.setter
+    def time(self, t):
+        Fleet.time[self.id] = t
+
+    @property
+    def loc(self):
+        return self._loc
+
+    @loc.setter
+    def loc(self, loc):
+        self._loc = loc
+        Fleet.source[self.id] = loc.source
+        Fleet.target[self.id] = loc.target
+        Fleet.fromSource[self.id] = loc.timeFromSource
+        Fleet.toTarget[self.id] = loc.timeFromTarget
+
     # NOTE: move cruise() method to HV/AV subclass methods if their behaviours are significantly different
     # NOTE: End cruise at simulation end time to prevent infinite cruising
     # def cruise(self, random_destination=True):
@@ -124,6 +255,9 @@ class HV(Vehicle):
         super().__init__(time, loc)
         self.is_HV = True
         HVs[self.id] = self  # Instantiated as vacant HV
+        Fleet.is_HV[self.id] = True
+        Fleet.update(self, Fleet.VACANT)
+        EndShift(time + maximumWork, self)  # Vacant HVs also leave when the maximum work duration is reached
 
         # Driver behavioural attributes
         self.neoclassical = neo
@@ -143,20 +277,20 @@ class HV(Vehicle):
         if exitTime - self.entranceTime >= maximumWork or end:
             # Update market count statistics
             Statistics.HV_total -= 1
+            Fleet.update(self, Fleet.EXITED)
 
             # Force exit labour market and record data ['v_id', 'is_HV', 'neoclassical', 'income', 'time', 'activation']
             Statistics.vehicle_data.append([self.id, True, self.neoclassical, self.income, exitTime, False])
         else:
             # if self.neoclassical and (Variables.unitWage * Variables.HV_utilisation * 3600 >= self.hourlyCost):
-            if self.neoclassical and (Variables.unitWage * Statistics.HV_no / Statistics.HV_total * 3600 >= self.hourlyCost):
-                # Neoclassical drivers continue to work if current unit wage >= unit cost
-                HVs[self.id] = self
-            elif ~self.neoclassical and (self.income < self.targetIncome):
-                # Income-targeting drivers continue to work if accumulated income < target income
+            if HV_continues(self.neoclassical, self.hourlyCost, self.income, self.targetIncome,
+                            Statistics.HV_occupied.count(exitTime), Statistics.HV_total):
                 HVs[self.id] = self
+                Fleet.update(self, Fleet.VACANT)
             else:
                 # Update market count statistics
                 Statistics.HV_total -= 1
+                Fleet.update(self, Fleet.EXITED)
 
                 # Exit labour market and record data ['v_id', 'is_HV', 'neoclassical', 'income', 'time', 'activation']
                 Statistics.vehicle_data.append([self.id, True, self.neoclassical, self.income, exitTime, False])
@@ -167,6 +301,7 @@ class AV(Vehicle):
         super().__init__(time, loc)
         self.is_HV = False
         inactiveAVs[self.id] = self  # AVs are loaded as inactive
+        Fleet.update(self, Fleet.INACTIVE)
 
     def __repr__(self):
         return 'AV{}'.format(self.id)
@@ -177,6 +312,7 @@ class AV(Vehicle):
         # if cruiseAV:
         #     self.nextTrip = TripCompletion(self.time, self)
         activeAVs[self.id] = inactiveAVs.pop(self.id)
+        Fleet.update(self, Fleet.VACANT)
 
         # Record data ['v_id', 'is_HV', 'neoclassical', 'income', 'time', 'activation']
         Statistics.vehicle_data.append([self.id, False, None, self.income, self.time, True])
@@ -197,6 +333,7 @@ class AV(Vehicle):
         self.loc = depot
 
         inactiveAVs[self.id] = activeAVs.pop(self.id)
+        Fleet.update(self, Fleet.INACTIVE)
 
 
 class TripCompletion(Event):
@@ -231,6 +368,7 @@ class TripCompletion(Event):
                 Statistics.AV_trips += 1
 
                 activeAVs[self.vehicle.id] = self.vehicle
+                Fleet.update(self.vehicle, Fleet.VACANT)
 
             # Record utilisation data ['time', 'v_id', 'trip_utilisation']
             Statistics.utilisation_data.append([self.time, self.vehicle.id, newRatio])
@@ -286,6 +424,21 @@ class DeactivateAVs(Event):
                 Statistics.vehicle_data.append([v.id, False, None, v.income, self.time, False])
 
 
+class EndShift(Event):
+    def __init__(self, time, vehicle):
+        super().__init__(time, priority=0)
+        self.vehicle = vehicle
+
+    def __repr__(self):
+        return 'EndShift_{}@t{}'.format(self.vehicle, self.time)
+
+    def trigger(self):
+        # Occupied HVs check the maximum work duration at drop-off, and HVs which already exited are skipped
+        if self.vehicle.id in HVs:
+            del HVs[self.vehicle.id]
+            self.vehicle.decide_exit(self.time)
+
+
 class NewHV(Event):
     firstTime = True
 
@@ -300,19 +453,17 @@ class NewHV(Event):
         return 'NewHV@t{}'.format(self.time)
 
     def trigger(self):
-        # Income-targeting drivers always start work to make an income
-        # Neoclassical drivers start work if expected revenue >= hourly cost at start times
         # expectedWage = Variables.unitWage * 3600 * Variables.HV_utilisation
         # TODO: what utilisation to use during warm-up
         if Statistics.HV_total > 0 and not NewHV.firstTime:
-            expectedWage = Variables.unitWage * 3600 * Statistics.HV_no / Statistics.HV_total
+            expectedWage = Variables.unitWage * 3600 * Statistics.HV_occupied.count(self.time) / Statistics.HV_total
         else:
             expectedWage = Variables.unitWage * 3600 * 0.6
             NewHV.firstTime = False
 
-        if ~self.neo or (expectedWage >= self.hourlyCost):
+        if HV_joins(self.neo, self.hourlyCost, expectedWage):
             HV(self.time, self.loc, self.neo, self.hourlyCost, self.targetIncome)
         elif self.neo and (self.time + 300 < Statistics.lastPassengerTime) and \
-                (self.hourlyCost - expectedWage) / self.hourlyCost < np.random.rand():
+                HV_retries(self.hourlyCost, expectedWage, np.random.rand()):
             # Neoclassical drivers may try to join the market again in 5 minutes (before last passenger) with binary Logit choice
             NewHV(self.time + 300, self.loc, self.neo, self.hourlyCost, self.targetIncome)
@@ -0,0 +1,101 @@
+import os
+import sys
+import time
+import struct
+import atexit
+import importlib
+import numpy as np
+import pandas as pd
+
+
+# Binary trace of assignment rounds, for offline benchmarking of matching backends.
+# The file starts with MAGIC, followed by rounds of
+#   header  : time (int64), is_HV (uint8), number of vehicles nV (uint32), number of passengers nP (uint32)
+#   vehicles: source (int64[nV]), target (int64[nV]), location from source (float64[nV])
+#   passengers (origins): source (int64[nP]), target (int64[nP]), location from source (float64[nP])
+MAGIC = b'MFTRACE1'
+HEADER = struct.Struct('<qBII')
+
+
+class AssignmentTrace:
+    def __init__(self, trace_file):
+        self.file = open(trace_file, 'wb')
+        self.file.write(MAGIC)
+        atexit.register(self.close)
+
+    def record(self, t, is_HV, vacant_v, waiting_p):
+        if (not vacant_v) | (not waiting_p):
+            return  # Rounds without matching are not recorded
+
+        locations = [v.loc for v in vacant_v] + [p.origin for p in waiting_p]
+        self.file.write(HEADER.pack(int(t), is_HV, len(vacant_v), len(waiting_p)))
+        for i, j in ((0, len(vacant_v)), (len(vacant_v), len(locations))):
+            self.file.write(np.array([loc.source for loc in locations[i:j]], dtype=np.int64).tobytes())
+            self.file.write(np.array([loc.target for loc in locations[i:j]], dtype=np.int64).tobytes())
+            self.file.write(np.array([loc.locFromSource for loc in locations[i:j]], dtype=np.float64).tobytes())
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+
+# Generator of recorded rounds: (time, is_HV, vehicle locations, passenger origins) as arrays of (source, target, loc)
+def read_trace(trace_file):
+    with open(trace_file, 'rb') as f:
+        assert f.read(len(MAGIC)) == MAGIC, 'Cannot recognise assignment trace {}.'.format(trace_file)
+        while header := f.read(HEADER.size):
+            t, is_HV, nV, nP = HEADER.unpack(header)
+            agents = []
+            for n in (nV, nP):
+                source = np.frombuffer(f.read(8 * n), dtype=np.int64)
+                target = np.frombuffer(f.read(8 * n), dtype=np.int64)
+                loc = np.frombuffer(f.read(8 * n), dtype=np.float64)
+                agents.append((source, target, loc))
+            yield t, bool(is_HV), agents[0], agents[1]
+
+
+# Stand-in agents with the attributes used by matching backends
+class TraceVehicle:
+    def __init__(self, loc):
+        self.loc = loc
+
+
+class TracePassenger:
+    def __init__(self, origin):
+        self.origin = origin
+
+
+def replay(trace_file, backend='Management:bipartite_match'):
+    from Configuration import configs
+    from Basics import Location
+
+    recording = configs['assignment_trace']
+    assert not (recording and os.path.abspath(recording) == os.path.abspath(trace_file)), \
+        'Cannot replay {}, which is the assignment_trace recorded (and overwritten) by simulations.'.format(trace_file)
+
+    module, function = backend.split(':')
+    match = getattr(importlib.import_module(module), function)
+
+    def locations(source, target, loc):
+        return [Location(int(s)) if s == g else Location(int(s), int(g), float(d)) for s, g, d in zip(source, target, loc)]
+
+    report = []
+    for t, is_HV, vehicles, passengers in read_trace(trace_file):
+        vacant_v = [TraceVehicle(loc) for loc in locations(*vehicles)]
+        waiting_p = [TracePassenger(loc) for loc in locations(*passengers)]
+
+        _t0 = time.perf_counter()
+        results = match(vacant_v, waiting_p) or []
+        latency = time.perf_counter() - _t0
+
+        report.append([t, is_HV, len(vacant_v), len(waiting_p), len(results), sum(m[2] for m in results), latency])
+    return pd.DataFrame(report, columns=['time', 'is_HV', 'vehicles', 'passengers', 'matched', 'objective', 'latency'])
+
+
+# Usage: python Trace.py trace_file [module:function] [report.csv]
+if __name__ == '__main__':
+    df = replay(*sys.argv[1:3])
+    if len(sys.argv) > 3:
+        df.to_csv(sys.argv[3], index=False)
+    print('Replayed {} rounds: total objective {}, latency total {:.3f} sec, mean {:.4f} sec, p95 {:.4f} sec.'.format(
+        len(df), df['objective'].sum(), df['latency'].sum(), df['latency'].mean(), df['latency'].quantile(0.95)))
@@ -0,0 +1,98 @@
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')  # Headless rendering
+import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+
+from Configuration import configs
+from Control import read_results
+from Map import G, edgeSource, edgeTarget, edge_positions
+
+
+# Time-lapse visualisation of simulation results.
+# Vehicles, pick-ups and expirations are aggregated from the output tables into frames of raster grids (occupied
+# vehicles) and per-edge counts (pick-ups), with expired passengers as points, then frames are rendered in parallel.
+#
+# Usage: python Visualisation.py [output_number] [frame interval (sec)] [frame directory]
+pos = np.array([G.nodes[n]['pos'] for n in G.nodes])
+extent = [pos[:, 0].min(), pos[:, 0].max(), pos[:, 1].min(), pos[:, 1].max()]
+
+
+def aggregate_frames(path, number, interval=900, bins=200):
+    passengers = read_results(path, number, 'passenger_data').set_index('p_id')
+    assignments = read_results(path, number, 'assignment_data')
+    expirations = read_results(path, number, 'expiration_data')
+
+    # Positions of passenger origins and destinations, computed once for all passengers
+    pickupEdge, origin = edge_positions(passengers['o_source'], passengers['o_target'], passengers['o_loc'])
+    _, destination = edge_positions(passengers['d_source'], passengers['d_target'], passengers['d_loc'])
+    row = passengers.index.get_indexer
+
+    a = row(assignments['p_id'])
+    meeting = assignments['meeting_t'].to_numpy()
+    delivery = assignments['delivery_t'].to_numpy()
+    e = row(expirations['p_id'])
+    expire = expirations['expire_t'].to_numpy()
+
+    times = np.arange(0, max(delivery.max(initial=0), expire.max(initial=0)) + interval, interval)
+    xBins = np.linspace(extent[0], extent[1], bins + 1)
+    yBins = np.linspace(extent[2], extent[3], bins + 1)
+
+    # Pick-ups per edge and frame, by vectorised binning on (frame, edge)
+    pickupFrame = (meeting // interval).astype(int)
+    onEdge = pickupEdge[a] >= 0
+    pickups = np.zeros((len(times), len(edgeSource)), dtype=int)
+    np.add.at(pickups, (pickupFrame[onEdge], pickupEdge[a][onEdge]), 1)
+
+    frames = []
+    for i, t in enumerate(times):
+        # Occupied vehicles at time t, positioned along the straight line from origin to destination
+        occupied = (meeting <= t) & (t < delivery)
+        progress = ((t - meeting[occupied]) / np.maximum(delivery[occupied] - meeting[occupied], 1))[:, None]
+        xy = origin[a[occupied]] + progress * (destination[a[occupied]] - origin[a[occupied]])
+        grid, _, _ = np.histogram2d(xy[:, 1], xy[:, 0], bins=[yBins, xBins])
+
+        expired = (t <= expire) & (expire < t + interval)
+        frames.append({'time': t, 'occupied': grid, 'pickups': pickups[i], 'expired': origin[e[expired]]})
+    return frames
+
+
+def render_frame(frame, file):
+    fig, ax = plt.subplots(figsize=(6, 8), dpi=150, tight_layout=True)
+    ax.set_aspect('equal')
+    ax.set_axis_off()
+
+    width = 0.3 + np.minimum(frame['pickups'], 5)
+    colors = np.where(frame['pickups'][:, None] > 0, [0.1, 0.6, 0.2, 1.0], [0.7, 0.7, 0.7, 1.0])
+    ax.add_collection(LineCollection(np.stack([edgeSource, edgeTarget], axis=1), linewidths=width, colors=colors))
+
+    occupied = np.ma.masked_equal(frame['occupied'], 0)
+    ax.imshow(occupied, extent=extent, origin='lower', cmap='plasma', alpha=0.8, interpolation='nearest')
+    ax.scatter(frame['expired'][:, 0], frame['expired'][:, 1], s=4, c='r', label='Expired')
+
+    ax.set_xlim(extent[0], extent[1])
+    ax.set_ylim(extent[2], extent[3])
+    clock = int(frame['time']) + 4 * 3600  # Simulation starts at 04:00
+    ax.set_title('Day {} {:02d}:{:02d}, {} occupied vehicles'.format(
+        clock // 86400, clock % 86400 // 3600, clock % 3600 // 60, int(frame['occupied'].sum())))
+    fig.savefig(file)
+    plt.close(fig)
+    return file
+
+
+def render_frames(frames, directory, workers=None):
+    os.makedirs(directory, exist_ok=True)
+    files = ['{}/frame_{:04d}.png'.format(directory, i) for i in range(len(frames))]
+    with ProcessPoolExecutor(workers) as pool:
+        return list(pool.map(render_frame, frames, files))
+
+
+if __name__ == '__main__':
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else configs['output_number']
+    interval = int(sys.argv[2]) if len(sys.argv) > 2 else 900
+    directory = sys.argv[3] if len(sys.argv) > 3 else '{}/sim{}_frames'.format(configs['data_output_path'], number)
+    files = render_frames(aggregate_frames(configs['data_output_path'], number, interval), directory)
+    print('Rendered {} frames to {}.'.format(len(files), directory))